@@ -0,0 +1,165 @@
+"""
+activity.py - Coalesced Session.lastactivity updates
+
+touch(id_session) only records the time in memory. A background thread
+writes the latest time of every session that was touched with one UPDATE
+(per UPDATE_BATCH sessions) every ACTIVITY_FLUSH_INTERVAL seconds, or
+sooner when an update has been waiting for ACTIVITY_MAX_STALENESS seconds.
+The UPDATE only moves lastactivity forward, so a process flushing an older
+time than another one doesn't roll it back.
+
+Idle periods are derived from the database, not from the touches seen by
+one process (the other workers serve hits of the same sessions): before
+the UPDATE, the stored lastactivity of each session is read, and when the
+first touch since the previous flush is more than IDLE_THRESHOLD seconds
+later, the gap is recorded as an Idle row. IDLE_THRESHOLD must be longer
+than the flush delay for that to hold. Two processes flushing at the same
+time can still both see the old lastactivity; the window is at most
+ACTIVITY_MAX_STALENESS seconds.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from . import models as M
+from .db import Db
+
+# sessions per UPDATE (each takes 5 query parameters)
+UPDATE_BATCH = 150
+# sessions that weren't touched by this process for that long (in sec) are
+# forgotten by lastActivity
+FORGET_AFTER = 24 * 3600
+
+UPDATE_QUERY = """
+UPDATE base_session SET lastactivity = CASE id %(case)s END
+WHERE id IN (%(ids)s) AND (lastactivity IS NULL OR lastactivity < CASE id %(case)s END)"""
+
+
+class ActivityTracker:
+    def __init__(self, flush_interval=None, max_staleness=None, idle_threshold=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, "ACTIVITY_FLUSH_INTERVAL", 30)
+        self.max_staleness = max_staleness if max_staleness is not None else getattr(
+            settings, "ACTIVITY_MAX_STALENESS", 10)
+        self.idle_threshold = idle_threshold if idle_threshold is not None else getattr(
+            settings, "IDLE_THRESHOLD", 300)
+        self._last = {}     # id_session -> last activity seen in this process
+        self._dirty = {}    # id_session -> [first, last] activity not written yet
+        self._oldest = None  # monotonic time of the oldest update not written yet
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def touch(self, id_session, when=None):
+        if when is None:
+            when = datetime.now()
+        with self._cond:
+            if self._thread is None and not self._stopping:
+                self._thread = threading.Thread(target=self._run, name="session-activity", daemon=True)
+                self._thread.start()
+            prev = self._last.get(id_session)
+            if prev is not None and when <= prev:
+                return
+            self._last[id_session] = when
+            pending = self._dirty.get(id_session)
+            if pending is None:
+                self._dirty[id_session] = [when, when]
+            else:
+                pending[1] = when
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def lastActivity(self, id_session):
+        """the last activity of that session seen by this process, or None"""
+        with self._cond:
+            return self._last.get(id_session)
+
+    def flush(self):
+        """writes the pending lastactivity updates and Idle rows"""
+        with self._flush_lock:
+            with self._cond:
+                dirty, self._dirty = self._dirty, {}
+                self._oldest = None
+            if not dirty:
+                return
+            db = Db()
+            ops = connections[db.dbconf].ops
+            items = list(dirty.items())
+            for i in range(0, len(items), UPDATE_BATCH):
+                batch = items[i:i + UPDATE_BATCH]
+                try:
+                    idles = self._idles(batch)
+                    case = []
+                    for id_session, (_, last) in batch:
+                        case.extend((id_session, ops.adapt_datetimefield_value(last)))
+                    ids = [id_session for id_session, _ in batch]
+                    db.doTransaction(UPDATE_QUERY % {"case": " ".join(["WHEN ? THEN ?"] * len(batch)),
+                                                     "ids": ", ".join(["?"] * len(batch))},
+                                     case + ids + case,
+                                     # a full batch is always the same query
+                                     prepare=len(batch) == UPDATE_BATCH)
+                    if idles:
+                        db.insertObjects(M.Idle, idles)
+                except Exception:
+                    logging.exception("[activity] could not write %s sessions", len(batch))
+            # forget the sessions that didn't show up for a while
+            cutoff = datetime.now() - timedelta(seconds=FORGET_AFTER)
+            with self._cond:
+                for id_session in [k for k, v in self._last.items() if v < cutoff and k not in self._dirty]:
+                    del self._last[id_session]
+
+    def _idles(self, batch):
+        # Idle rows for the sessions whose stored lastactivity is more than
+        # idle_threshold before their first touch since the previous flush
+        threshold = timedelta(seconds=self.idle_threshold)
+        stored = dict(M.Session.objects.filter(id__in=[id_session for id_session, _ in batch]).values_list(
+            "id", "lastactivity"))
+        idles = []
+        for id_session, (first, _) in batch:
+            t1 = stored.get(id_session)
+            if t1 is None:
+                continue
+            if timezone.is_aware(t1):
+                t1 = timezone.make_naive(t1)
+            if first - t1 > threshold:
+                idles.append(M.Idle(session_id=id_session, t1=t1, t2=first))
+        return idles
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping:
+                    now = time.monotonic()
+                    if now >= deadline or (self._oldest is not None and now - self._oldest >= self.max_staleness):
+                        break
+                    self._cond.wait(min(deadline - now, 1))
+                if self._stopping:
+                    return
+            self.flush()
+
+
+tracker = ActivityTracker()
+
+
+def touch(id_session, when=None):
+    tracker.touch(id_session, when)
+
+
+atexit.register(tracker.stop)
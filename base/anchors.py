@@ -0,0 +1,133 @@
+"""
+anchors.py - Index of the HTML5Location anchors of a source
+
+On HTML5 sources a location is a DOM range: path1/offset1 to path2/offset2,
+the paths being "/"-separated steps from the document root. anchors.source
+(id_source) loads them with one query and parses every path once into a
+trie of interned steps, shared by all the anchors that have a common
+prefix. Each anchor only keeps the trie node ids of its two paths, in
+arrays, so that pages with tens of thousands of anchors stay small.
+within(path) returns the locations whose range lies inside that subtree.
+"""
+import sys
+from array import array
+
+from django.conf import settings
+
+from . import models as M
+from .perms import TTLCache
+
+
+class AnchorIndex:
+    def __init__(self, rows):
+        """rows: (location_id, path1, offset1, path2, offset2)"""
+        # trie: node 0 is the root
+        self._parent = array("l", [-1])
+        self._step = [None]
+        self._children = [{}]
+        self._ids = array("l")
+        self._node1 = array("l")
+        self._node2 = array("l")
+        self._offset1 = array("l")
+        self._offset2 = array("l")
+        self._by_node = {}  # node -> positions of the anchors whose path1 ends there
+        nodes = {}  # path -> node, while loading
+        for id, path1, offset1, path2, offset2 in rows:
+            n1 = nodes.get(path1)
+            if n1 is None:
+                n1 = nodes[path1] = self._insert(path1)
+            n2 = nodes.get(path2)
+            if n2 is None:
+                n2 = nodes[path2] = self._insert(path2)
+            self._by_node.setdefault(n1, array("l")).append(len(self._ids))
+            self._ids.append(id)
+            self._node1.append(n1)
+            self._node2.append(n2)
+            self._offset1.append(offset1)
+            self._offset2.append(offset2)
+
+    @staticmethod
+    def _steps(path):
+        return [s for s in (path or "").split("/") if s]
+
+    def _insert(self, path):
+        node = 0
+        for step in self._steps(path):
+            child = self._children[node].get(step)
+            if child is None:
+                child = len(self._step)
+                self._children[node][sys.intern(step)] = child
+                self._children.append({})
+                self._parent.append(node)
+                self._step.append(sys.intern(step))
+            node = child
+        return node
+
+    def _find(self, path):
+        node = 0
+        for step in self._steps(path):
+            node = self._children[node].get(step)
+            if node is None:
+                return None
+        return node
+
+    def _path(self, node):
+        steps = []
+        while node > 0:
+            steps.append(self._step[node])
+            node = self._parent[node]
+        return "/" + "/".join(reversed(steps))
+
+    def _isUnder(self, node, ancestor):
+        # children always get a higher node id than their parent
+        while node > ancestor:
+            node = self._parent[node]
+        return node == ancestor
+
+    def within(self, path):
+        """ids of the locations whose start and end are both in the subtree at path (included)"""
+        top = self._find(path)
+        if top is None:
+            return []
+        out = []
+        stack = [top]
+        while stack:
+            node = stack.pop()
+            for i in self._by_node.get(node, ()):
+                if self._isUnder(self._node2[i], top):
+                    out.append(self._ids[i])
+            stack.extend(self._children[node].values())
+        return out
+
+    def anchors(self):
+        """(location_id, path1, offset1, path2, offset2) for each anchor, with the paths normalized"""
+        for i in range(len(self._ids)):
+            yield (self._ids[i], self._path(self._node1[i]), self._offset1[i],
+                   self._path(self._node2[i]), self._offset2[i])
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class AnchorIndexes:
+    def __init__(self):
+        self._sources = TTLCache(getattr(settings, "ANCHOR_CACHE_TTL", 300),
+                                 getattr(settings, "ANCHOR_CACHE_SIZE", 200))
+
+    def source(self, id_source):
+        id_source = int(id_source)
+        index = self._sources.get(id_source)
+        if index is None:
+            index = AnchorIndex(M.HTML5Location.objects.filter(location__source_id=id_source).values_list(
+                "location_id", "path1", "offset1", "path2", "offset2").iterator())
+            self._sources.set(id_source, index)
+        return index
+
+    def invalidate(self, id_source):
+        self._sources.pop(int(id_source))
+
+    def clear(self):
+        self._sources.clear()
+
+
+anchors = AnchorIndexes()
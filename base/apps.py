@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BaseConfig(AppConfig):
     name = 'base'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,30 +1,27 @@
 from . import models as M
+from . import folders
+from . import guests
+from .perms import resolver
+from django.db.models import Case, IntegerField, Q, When
 import random
-import string
 
 
 def confirmInvite(id):
-    invite = M.Invite.objects.filter(key=id)
-    if len(invite) == 0:
+    invite = M.Invite.objects.filter(key=id).first()
+    if invite is None:
         return None
-    invite = invite[0]
-    membership = M.Membership.objects.filter(
-        user=invite.user_id, ensemble=invite.ensemble_id, deleted=False)
-    if len(membership) == 0:
+    if resolver.membership(invite.user_id, invite.ensemble_id) is None:
         membership = M.Membership()
-        membership.user = invite.user
-        membership.ensemble = invite.ensemble
+        membership.user_id = invite.user_id
+        membership.ensemble_id = invite.ensemble_id
         membership.admin = invite.admin
-        membership.section = invite.section
+        membership.section_id = invite.section_id
         membership.save()
     return invite
 
 
 def invite2uid(id):
-    invite = M.Invite.objects.filter(key=id)
-    if len(invite) == 0:
-        return None
-    return invite[0].user.id
+    return M.Invite.objects.filter(key=id).values_list("user_id", flat=True).first()
 
 
 def canReadFile(uid, id_source, req=None):
@@ -32,9 +29,8 @@ def canReadFile(uid, id_source, req=None):
         id_source = int(id_source)
     except ValueError:
         return False
-    o = M.Membership.objects.filter(ensemble__in=M.Ensemble.objects.filter(ownership__in=M.Ownership.objects.filter(
-        source__id=id_source,  deleted=False))).filter(user__id=uid,  deleted=False, guest=False)
-    return len(o) > 0 or canGuestReadFile(uid, id_source, req)
+    o = resolver.sourceMemberships(uid, id_source)
+    return any(not m.guest for m in o) or canGuestReadFile(uid, id_source, req)
 
 
 def canDownloadFileComments(uid, id_source):
@@ -43,9 +39,8 @@ def canDownloadFileComments(uid, id_source):
         id_source = int(id_source)
     except ValueError:
         return False
-    o = M.Membership.objects.filter(ensemble__in=M.Ensemble.objects.filter(
-        ownership__in=M.Ownership.objects.filter(source__id=id_source))).filter(user__id=uid, deleted=False)
-    return len(o) > 0 and o[0].admin
+    o = resolver.sourceMemberships(uid, id_source, include_deleted=True)
+    return any(m.admin for m in o)
 
 
 def canDownloadPDF(uid, id_source):
@@ -53,38 +48,55 @@ def canDownloadPDF(uid, id_source):
         id_source = int(id_source)
     except ValueError:
         return False
-    o = M.Membership.objects.filter(ensemble__in=M.Ensemble.objects.filter(
-        ownership__in=M.Ownership.objects.filter(source__id=id_source))).filter(user__id=uid, deleted=False)
-    return (len(o) > 0 and (o[0].admin or o[0].ensemble.allow_download)) or canGuestDownloadPDF(id_source)
+    for owner in resolver.owners(id_source):
+        m = resolver.membership(uid, owner.ensemble_id)
+        if m is not None and (m.admin or resolver.ensemble(owner.ensemble_id).allow_download):
+            return True
+    return canGuestDownloadPDF(id_source)
+
+
+def readable_sources(uid, ids):
+    """Batch version of canReadFile: returns the subset of ids that uid can read.
+    Unlike canGuestReadFile, this doesn't create guest memberships."""
+    eids = [eid for eid, m in resolver.memberships(uid).items() if not m.guest]
+    o = M.Ownership.objects.filter(source__id__in=ids).filter(
+        Q(deleted=False, ensemble__id__in=eids) | Q(ensemble__allow_guest=True))
+    return set(o.values_list("source_id", flat=True))
 
 
 def canGuestReadFile(uid, id_source, req=None):
-    o = M.Ownership.objects.get(source__id=id_source)
-    e = M.Ensemble.objects.get(pk=o.ensemble_id)
-    if o.ensemble.allow_guest and len(M.Membership.objects.filter(user__id=uid, ensemble=e, deleted=False)) == 0:
+    eid = M.Ownership.objects.values_list("ensemble_id", flat=True).filter(source__id=id_source).first()
+    if eid is None:
+        # no such source
+        return False
+    e = resolver.ensemble(eid)
+    if e.allow_guest and resolver.membership(uid, eid) is None:
         # add membership for guest user:
         m = M.Membership()
         m.user_id = uid
-        m.ensemble_id = e.id
+        m.ensemble_id = eid
         m.guest = True
         if e.section_assignment == M.Ensemble.SECTION_ASSGT_RAND:
             # assign guest to a random section if there are sections, unless we find a pgid cookie that correponded to a existing section
-            sections = M.Section.objects.filter(ensemble=e)
+            sections = list(M.Section.objects.filter(
+                ensemble__id=eid).values_list("id", flat=True))
             if sections:
                 if req is not None and "pgid" in req.COOKIES:
-                    prev_sections = M.Section.objects.filter(membership__user__id=int(
-                        req.COOKIES.get("pgid")), membership__ensemble__id=e.id)
-                    if len(prev_sections):
-                        m.section = prev_sections[0]
-                if m.section is None:
-                    m.section = random.choice(sections)
+                    m.section_id = M.Section.objects.filter(membership__user__id=int(
+                        req.COOKIES.get("pgid")), membership__ensemble__id=eid).values_list("id", flat=True).first()
+                if m.section_id is None:
+                    m.section_id = random.choice(sections)
         m.save()
-    return o.ensemble.allow_guest
+    return e.allow_guest
 
 
 def canGuestDownloadPDF(id_source):
-    o = M.Ownership.objects.get(source__id=id_source)
-    return o.ensemble.allow_guest and o.ensemble.allow_download
+    eid = M.Ownership.objects.values_list("ensemble_id", flat=True).filter(source__id=id_source).first()
+    if eid is None:
+        # no such source
+        return False
+    e = resolver.ensemble(eid)
+    return e.allow_guest and e.allow_download
 
 
 def getGuest(ckey=None):
@@ -115,46 +127,44 @@ def getCkeyInfo(ckey):
 
 def canAnnotate(uid, eid):
     """Need to be a either a member of a group or a registered user for a public group """
-    o = M.Membership.objects.filter(
-        ensemble__id=eid, user__id=uid, deleted=False)
-    if len(o) > 0:
+    if resolver.membership(uid, eid) is not None:
         return True
     # TODO registered user and public group ?
-    e = M.Ensemble.objects.get(pk=eid)
-    if e.allow_guest:
-        u = M.User.objects.get(pk=uid)
-        return not u.guest
+    if resolver.ensemble(eid).allow_guest:
+        return not M.User.objects.values_list("guest", flat=True).get(pk=uid)
     return False
 
 
 def canImportAnnotation(uid, from_id_source, to_id_source):
     """Need to be an admin of the FROM ensemble, and canAnnotate in the TO ensemble"""
-    from_ownership = M.Ownership.objects.get(source__id=from_id_source)
-    from_ensemble = from_ownership.ensemble
-
-    to_ownership = M.Ownership.objects.get(source__id=to_id_source)
-    to_ensemble = to_ownership.ensemble
+    from_eid = M.Ownership.objects.values_list(
+        "ensemble_id", flat=True).get(source__id=from_id_source)
+    to_eid = M.Ownership.objects.values_list(
+        "ensemble_id", flat=True).get(source__id=to_id_source)
 
-    o = M.Membership.objects.filter(
-        ensemble__id=from_ensemble.pk, user__id=uid, deleted=False, admin=True)
-    if len(o) == 0:
+    m = resolver.membership(uid, from_eid)
+    if m is None or not m.admin:
         return False
 
-    return canAnnotate(uid, to_ensemble.pk)
+    return canAnnotate(uid, to_eid)
 
 
 def canAdministrateLocation(uid, id_location):
-    ensemble = M.Location.objects.get(pk=id_location).ensemble
-    o = M.Membership.objects.filter(
-        ensemble__id=ensemble.pk, user__id=uid, deleted=False, admin=True)
-    return (len(o) != 0)
+    eid = M.Location.objects.values_list(
+        "ensemble_id", flat=True).get(pk=id_location)
+    m = resolver.membership(uid, eid)
+    return m is not None and m.admin
 
 
 def addUser(email, password, conf, valid=0, guest=0):
     o = M.User()
     o.email = email
     o.password = None
-    o.set_password(password)
+    if guest:
+        # guests log in with their confkey, never with a password
+        o.set_unusable_password()
+    else:
+        o.set_password(password)
     o.confkey = conf
     o.valid = valid
     o.guest = guest
@@ -176,12 +186,12 @@ def addInvite(key, id_user, id_ensemble, id_section, admin):
 
 
 def createGuest():
-    key = "".join([random.choice(string.ascii_letters+string.digits)
-                  for i in range(0, 20)])
+    o = guests.pool.claim()
+    if o is not None:
+        return o
+    key = guests.newKey()
     email = "guest_%s@nb.test" % (key, )
-    passwd = "".join([random.choice(string.ascii_letters+string.digits)
-                     for i in range(0, 4)])
-    return addUser(email, passwd, key, 0, 1)
+    return addUser(email, None, key, 0, 1)
 
 
 def getGuestCkey():
@@ -189,19 +199,19 @@ def getGuestCkey():
 
 
 def user_from_email(email):
-    users = M.User.objects.filter(email=email)
+    users = M.User.objects.filter(email=email)[:2]
     return users[0] if len(users) == 1 else None
 
 
 def checkUser(email, password):
-    # allow case sensitive username
-    users = M.User.objects.filter(email=email.strip(), valid=1, guest=0)
-    if len(users) != 1:
-        # but backup plan is case insensitive
-        users = M.User.objects.filter(
-            email__iexact=email.strip(), valid=1, guest=0)
-        if len(users) != 1:
-            return None
+    # case insensitive, but an exact match wins when several users only
+    # differ by case. One query (cf the UPPER(email) index on PostgreSQL)
+    email = email.strip()
+    users = M.User.objects.filter(email__iexact=email, valid=1, guest=0).annotate(
+        exact=Case(When(email=email, then=1), default=0, output_field=IntegerField())).order_by("-exact")[:2]
+    users = list(users)
+    if not users or (len(users) > 1 and not users[0].exact):
+        return None
     user = users[0]
     return user if user.authenticate(password) else None
 
@@ -212,28 +222,27 @@ def canAddFolder(uid, id_ensemble, id_parent=None):
 
 def canInsertFile(uid, eid, id_folder=None):
     """need to be an admin on that membership, and the folder (if not None) needs to be in this membership"""
-    m = M.Membership.objects.get(ensemble__id=eid, user__id=uid, deleted=False)
+    admin = M.Membership.objects.values_list("admin", flat=True).get(
+        ensemble__id=eid, user__id=uid, deleted=False)
     if id_folder is None:
-        return m.admin
+        return admin
     else:
-        f = M.Folder.objects.get(pk=id_folder)
-        return f.ensemble_id == int(eid) and m.admin
+        f_eid = M.Folder.objects.values_list(
+            "ensemble_id", flat=True).get(pk=id_folder)
+        return f_eid == int(eid) and admin
 
 
 def canRenameFile(uid, id):
     """need to be an admin on the ensemble that contains that file"""
-    o = M.Ownership.objects.filter(source__id=id)
-    e = M.Ensemble.objects.filter(ownership__in=o)
-    m = M.Membership.objects.filter(
-        user__id=uid, ensemble__in=e, deleted=False)
-    return m.count() > 0 and m[0].admin
+    o = resolver.sourceMemberships(uid, id, include_deleted=True)
+    return any(m.admin for m in o)
 
 
 def canRenameFolder(uid, id):
     """need to be an admin on the ensemble that contains that folder"""
-    e = M.Folder.objects.get(pk=id).ensemble
-    m = M.Membership.objects.filter(user__id=uid, ensemble=e, deleted=False)
-    return m.count() > 0 and m[0].admin
+    m = resolver.membership(uid, M.Folder.objects.values_list(
+        "ensemble_id", flat=True).get(pk=id))
+    return m is not None and m.admin
 
 
 def canEditAssignment(uid, id):
@@ -250,32 +259,24 @@ def canDeleteFolder(uid, id):
         - Can't contain any file that's not already deleted
         - Can't contain any folder
     """
-    e = M.Folder.objects.get(pk=id).ensemble
-    m = M.Membership.objects.filter(user__id=uid, ensemble=e, deleted=False)
+    m = resolver.membership(uid, M.Folder.objects.values_list(
+        "ensemble_id", flat=True).get(pk=id))
+    if m is None or not m.admin:
+        return False
     o = M.Ownership.objects.filter(deleted=False, folder__id=id)
     f = M.Folder.objects.filter(parent__id=id)
-    return m.count() > 0 and m[0].admin and o.count() == 0 and f.count() == 0
+    return not o.exists() and not f.exists()
 
 
 def canMoveFile(uid, id, id_dest=None):
     return canRenameFile(uid, id)
 
 
-def __isDirOrParent(id_a, id_b):
-    # returns true is a == b or is a is a parent of b
-    d = M.Folder.objects.get(pk=id_b)
-    while d.parent_id is not None:
-        if d.id == id_a:
-            return True
-        d = d.parent
-    return id_a == d.id
-
-
 def canMoveFolder(uid, id, id_dest):
     """need to be an admin on the ensemble that contains that folder, and folder dest not to be the same or a subfolder of id"""
-    e = M.Folder.objects.get(pk=id).ensemble
-    m = M.Membership.objects.filter(user__id=uid, ensemble=e, deleted=False)
-    return m.count() > 0 and m[0].admin and not __isDirOrParent(id_dest, id)
+    m = resolver.membership(uid, M.Folder.objects.values_list(
+        "ensemble_id", flat=True).get(pk=id))
+    return m is not None and m.admin and not folders.isDirOrParent(id, id_dest)
 
 
 def canUpdateFile(uid, id):
@@ -284,9 +285,8 @@ def canUpdateFile(uid, id):
 
 def canSendInvite(uid, eid):
     """need to be an admin on that membership"""
-    m = M.Membership.objects.filter(
-        user__id=uid, ensemble__id=eid, deleted=False)
-    return m.count() > 0 and m[0].admin
+    m = resolver.membership(uid, eid)
+    return m is not None and m.admin
 
 
 def canEditEnsemble(uid, eid):
@@ -307,23 +307,20 @@ def canGetMembers(uid, eid):
 
 def canGrade(uid, id_source, id_student):
     """Need to be admin on ensemble that contains file and student needs to be a member of that ensemble"""
-    o = M.Ownership.objects.filter(source__id=id_source)
-    e = M.Ensemble.objects.filter(ownership__in=o)
-    m = M.Membership.objects.filter(
-        user__id=uid, ensemble__in=e, deleted=False)
-    m2 = M.Membership.objects.filter(
-        user__id=id_student, ensemble__in=e, deleted=False)
-    return m.count() > 0 and m[0].admin and m2.count() > 0
+    m = resolver.sourceMemberships(uid, id_source, include_deleted=True)
+    m2 = resolver.sourceMemberships(id_student, id_source, include_deleted=True)
+    return any(x.admin for x in m) and len(m2) > 0
 
 
 def isMember(user_id, ensemble_id):
-    return M.Membership.objects.filter(user__id=user_id, ensemble__id=ensemble_id, deleted=False).count() != 0
+    return resolver.membership(user_id, ensemble_id) is not None
 
 
 def canEdit(uid, id_ann):
     # uid need to be comment owner and there need to be no dependent non-deleted comment
-    o = M.Comment.objects.get(pk=id_ann)
-    return o.author_id == uid and M.Comment.objects.filter(parent=o, deleted=False).count() == 0
+    author_id = M.Comment.objects.values_list(
+        "author_id", flat=True).get(pk=id_ann)
+    return author_id == uid and not M.Comment.objects.filter(parent__id=id_ann, deleted=False).exists()
 
 
 def canDelete(uid, id_ann):
@@ -331,16 +328,36 @@ def canDelete(uid, id_ann):
 
 
 def canDeleteThread(uid, id_location):
-    m = M.Membership.objects.filter(
-        ensemble__location__id=id_location, user__id=uid, deleted=False, admin=True)
-    return m.count() > 0
+    eid = M.Location.objects.filter(pk=id_location).values_list(
+        "ensemble_id", flat=True).first()
+    if eid is None:
+        return False
+    m = resolver.membership(uid, eid)
+    return m is not None and m.admin
 
 
 def canLabelComment(uid, cid):
     # need to be an admin for the ensemble containing that comment.
-    m = M.Membership.objects.filter(
-        ensemble__location__comment__id=cid, user__id=uid, deleted=False, admin=True)
-    return m.count() > 0
+    eid = M.Comment.objects.filter(pk=cid).values_list(
+        "location__ensemble_id", flat=True).first()
+    if eid is None:
+        return False
+    m = resolver.membership(uid, eid)
+    return m is not None and m.admin
+
+
+def labelable_comments(uid, cids):
+    """Batch version of canLabelComment: returns the subset of cids that uid can label"""
+    eids = [eid for eid, m in resolver.memberships(uid).items() if m.admin]
+    o = M.Comment.objects.filter(id__in=cids, location__ensemble__id__in=eids)
+    return set(o.values_list("id", flat=True))
+
+
+def administrable_locations(uid, ids):
+    """Batch version of canAdministrateLocation: returns the subset of ids that uid can administrate"""
+    eids = [eid for eid, m in resolver.memberships(uid).items() if m.admin]
+    o = M.Location.objects.filter(id__in=ids, ensemble__id__in=eids)
+    return set(o.values_list("id", flat=True))
 
 
 def canPauseComment(uid, id_source):
@@ -349,13 +366,12 @@ def canPauseComment(uid, id_source):
 
 def canMarkThread(uid, id_location):
     # user needs to be able to read root comment in that location
-    location = M.Location.objects.get(pk=id_location)
-    root_comment = M.Comment.objects.get(parent=None, location=location)
-    if root_comment.author_id == uid:
+    author_id, ctype, eid = M.Comment.objects.values_list("author_id", "type", "location__ensemble_id").get(
+        parent=None, location__id=id_location)
+    if author_id == uid:
         return True
-    m = M.Membership.objects.filter(
-        ensemble=location.ensemble, user__id=uid, deleted=False)
-    return m.count() > 0 and (root_comment.type > 2 or (m[0].admin and root_comment.type > 1))
+    m = resolver.membership(uid, eid)
+    return m is not None and (ctype > 2 or (m.admin and ctype > 1))
 
 
 def log_guest_login(ckey, id_user):
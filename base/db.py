@@ -2,53 +2,315 @@
 db.py -  Database utilities
 """
 import datetime
+import hashlib
+import io
+import itertools
 import os
 import re
 import json
 import logging
-from django.db import connection, transaction
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from django.db import connections, transaction
+from django.db.utils import load_backend
 
 from django.conf import settings
 
 
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Pool of database connections for one entry of settings.DATABASES.
+    Options are read from the optional "POOL" dict of that entry:
+      MAX_SIZE: max number of connections open at the same time
+      IDLE_TIMEOUT: idle connections older than this (in sec) are closed
+      CHECKOUT_TIMEOUT: how long (in sec) checkout waits for a free connection
+      HEALTH_CHECK_AFTER: connections idle for longer than this (in sec) are
+                          tested before being handed out
+    Pooled connections are separate from Django's own connection, so they
+    run outside of its transaction: they don't see rows it hasn't committed
+    yet. Db.connection() hands out Django's connection instead while the
+    calling thread is inside transaction.atomic (and so inside a TestCase).
+    """
+
+    def __init__(self, dbconf):
+        self.dbconf = dbconf
+        options = settings.DATABASES[dbconf].get("POOL", {})
+        self.max_size = options.get("MAX_SIZE", 10)
+        self.idle_timeout = options.get("IDLE_TIMEOUT", 300)
+        self.checkout_timeout = options.get("CHECKOUT_TIMEOUT", 30)
+        self.health_check_after = options.get("HEALTH_CHECK_AFTER", 10)
+        self.size = 0
+        self._idle = []  # (connection, time it was returned), most recent last
+        self._cond = threading.Condition()
+
+    def _create(self):
+        settings_dict = connections[self.dbconf].settings_dict
+        conn = load_backend(settings_dict["ENGINE"]).DatabaseWrapper(
+            settings_dict, self.dbconf)
+        # pooled connections are handed out to whichever thread asks for them
+        conn.inc_thread_sharing()
+        return conn
+
+    def _discard(self, conn):
+        self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            logging.exception("[pool] error while closing connection")
+
+    def _evictIdle(self, now):
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            self._discard(self._idle.pop(0)[0])
+
+    def checkout(self):
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evictIdle(now)
+                if self._idle:
+                    conn, returned = self._idle.pop()
+                    if now - returned > self.health_check_after and conn.connection is not None and not conn.is_usable():
+                        self._discard(conn)
+                        continue
+                    return conn
+                if self.size < self.max_size:
+                    self.size += 1
+                    break
+                if now >= deadline:
+                    raise PoolExhausted("no connection available for %s after %ss" % (
+                        self.dbconf, self.checkout_timeout))
+                self._cond.wait(deadline - now)
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, conn):
+        with self._cond:
+            try:
+                if conn.connection is not None and not conn.get_autocommit():
+                    conn.rollback()
+                    conn.set_autocommit(True)
+            except Exception:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeAll(self):
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def getPool(dbconf):
+    with _pools_lock:
+        pool = _pools.get(dbconf)
+        if pool is None:
+            pool = _pools[dbconf] = ConnectionPool(dbconf)
+        return pool
+
+
+POSTGRES_ENGINES = ("django.db.backends.postgresql", "django.db.backends.postgresql_psycopg2")
+
+
+@lru_cache(maxsize=512)
+def toPyformat(qry):
+    # ? placeholders -> %s, the paramstyle of every Django backend (the
+    # SQLite one turns them back into ?, and its debug cursor does sql % params)
+    return qry.replace("?", "%s")
+
+
+@lru_cache(maxsize=128)
+def toPrepared(qry):
+    # returns (statement name, PREPARE sql, number of parameters)
+    parts = qry.split("?")
+    body = parts[0]
+    for i, part in enumerate(parts[1:], 1):
+        body += "$%d%s" % (i, part)
+    name = "docannot_" + hashlib.sha1(qry.encode("utf-8")).hexdigest()[:16]
+    return name, "PREPARE %s AS %s" % (name, body), len(parts) - 1
+
+
+def copyValue(v):
+    # one field in PostgreSQL's COPY text format
+    if v is None:
+        return "\\N"
+    if isinstance(v, bool):
+        return "t" if v else "f"
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def debugQuery(tag, qry, args):
+    # only formats the message when the query log is actually enabled
+    if getattr(settings, "DEBUG_QUERY", False):
+        logging.info("[%s] %s %r", tag, qry, args)
+
+
+class FetchedCursor:
+    """
+    The results of a query, fetched from cursor, with the (read-only) part
+    of the cursor API.
+    """
+
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self._rows = iter(cursor.fetchall() if cursor.description is not None else ())
+
+    def __iter__(self):
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=1):
+        return list(itertools.islice(self._rows, size))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        self._rows = iter(())
+
+
 class Db:
     def __init__(self, dbconf=None):
         if dbconf is None:
             dbconf = "default"
         self.dbconf = dbconf
         self.parms = settings.DATABASES[dbconf]
+        self.pool = getPool(dbconf)
         self.conn = None
+        self.postgres = self.parms["ENGINE"] in POSTGRES_ENGINES
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _checkout(self):
+        # inside transaction.atomic, use Django's connection so that queries
+        # see the rows written by that transaction
+        conn = connections[self.dbconf]
+        if conn.in_atomic_block:
+            return conn
+        return self.pool.checkout()
+
+    def _checkin(self, conn):
+        if conn is not connections[self.dbconf]:
+            self.pool.checkin(conn)
 
     def connectMaybe(self):
+        # self.conn stays checked out until close() is called (or the end of
+        # a "with Db() as db:" block)
+        if self.conn is None:
+            self.conn = self._checkout()
+        return self.conn
+
+    def close(self):
         if self.conn is not None:
-            return
-        return connection
+            self._checkin(self.conn)
+            self.conn = None
 
     def getNewConnection(self):
-        return connection
+        # caller needs to call releaseConnection when done
+        return self._checkout()
+
+    def releaseConnection(self, conn):
+        self._checkin(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._checkin(conn)
 
     def escape_string(self, s):
-        return connection.ops.quote_name(s)
+        return connections[self.dbconf].ops.quote_name(s)
 
-    def execute(self, qry, args, connection=None):
-        cursor = None
+    def execute(self, qry, args, connection=None, chunked=False, prepare=False):
+        # chunked: use a server-side cursor where the backend supports it
+        # prepare: on PostgreSQL, PREPARE the query once per connection and
+        #          EXECUTE it afterwards (for hot queries run over and over);
+        #          ignored on the other backends
+        # chunked and prepare don't go together: PostgreSQL can't DECLARE a
+        # cursor for an EXECUTE
+        # Without a connection, the rows are fetched right away and the
+        # connection goes back to the pool before returning
+        if chunked and prepare:
+            raise ValueError("a chunked cursor can't run a prepared statement")
         if connection is None:
-            self.connectMaybe()
-            cursor = self.conn.cursor()
+            if chunked:
+                raise ValueError("chunked execute needs a connection (cf iterRows)")
+            with self.connection() as conn:
+                with self.execute(qry, args, conn, prepare=prepare) as cursor:
+                    return FetchedCursor(cursor)
+        cursor = connection.chunked_cursor() if chunked else connection.cursor()
+        debugQuery("execute", qry, args)
+        if self.postgres and prepare:
+            name, prepare_qry, nargs = toPrepared(qry)
+            connection.ensure_connection()
+            # prepared statements belong to the underlying DB-API connection
+            raw, prepared = connection.__dict__.get("docannot_prepared", (None, None))
+            if raw is not connection.connection:
+                prepared = set()
+                connection.docannot_prepared = (connection.connection, prepared)
+            if name not in prepared:
+                with connection.cursor() as c:
+                    c.execute(prepare_qry)
+                prepared.add(name)
+            if nargs:
+                cursor.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * nargs)), args)
+            else:
+                cursor.execute("EXECUTE %s" % (name,))
         else:
-            cursor = connection.cursor()
-        # replace placeholder if in postgres mode
-        if self.parms["ENGINE"] == "django.db.backends.postgresql_psycopg2":
-            qry = qry.replace("?", "%s")
-        if settings.DEBUG_QUERY:
-            logging.info("[execute] " + qry % args)
-        cursor.execute(qry, args)
+            cursor.execute(toPyformat(qry), args)
         return cursor
 
-    def doTransaction(self, qry, args):
-        connection = self.getNewConnection()
-        cursor = self.execute(qry, args, connection)
-        transaction.commit_unless_managed()
+    def doTransaction(self, qry, args, prepare=False):
+        with self.connection() as conn:
+            if conn.in_atomic_block:
+                # a savepoint in the caller's transaction
+                with transaction.atomic(using=self.dbconf):
+                    self.execute(qry, args, conn, prepare=prepare).close()
+                return
+            conn.set_autocommit(False)
+            try:
+                cursor = self.execute(qry, args, conn, prepare=prepare)
+                cursor.close()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.set_autocommit(True)
 
     # same as getRows but returns the results in a dict index by the 1st val
     def getIndexedRows(self, qry, args):
@@ -61,45 +323,118 @@ class Db:
                 x[row[0]] = [row]
         return x
 
-    def getVal(self, qry, args):
-        connection = self.getNewConnection()
-        cursor = self.execute(qry, args, connection)
-        row = cursor.fetchone()
-        cursor.close()
+    def getVal(self, qry, args, prepare=False):
+        with self.connection() as conn:
+            cursor = self.execute(qry, args, conn, prepare=prepare)
+            row = cursor.fetchone()
+            cursor.close()
         if row is None:
             return None
         return row[0]
 
-    def getRow(self, qry, args):
-        connection = self.getNewConnection()
-        cursor = self.execute(qry, args, connection)
-        row = cursor.fetchone()
-        cursor.close()
+    def getRow(self, qry, args, prepare=False):
+        with self.connection() as conn:
+            cursor = self.execute(qry, args, conn, prepare=prepare)
+            row = cursor.fetchone()
+            cursor.close()
         return row
 
-    def getRows(self, qry, args):
-        if settings.DEBUG_QUERY:
-            debug_query = qry.replace("?", "%s")
-            logging.info("[getRows] " + debug_query % args)
-        connection = self.getNewConnection()
-        cursor = self.execute(qry, args, connection)
-        rows = cursor.fetchall()
-        cursor.close()
+    def getRows(self, qry, args, prepare=False):
+        with self.connection() as conn:
+            cursor = self.execute(qry, args, conn, prepare=prepare)
+            rows = cursor.fetchall()
+            cursor.close()
         return rows
 
+    # same as getRows, but only keeps batch_size rows in memory at a time.
+    # Uses a server-side cursor on PostgreSQL and fetchmany elsewhere.
+    def iterRows(self, qry, args, batch_size=None):
+        if batch_size is None:
+            batch_size = getattr(settings, "DB_FETCH_BATCH_SIZE", 2000)
+        with self.connection() as conn:
+            cursor = self.execute(qry, args, conn, chunked=True)
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
+
+    def __fieldIndex(self, c, names):
+        d = {}
+        for i in range(0, len(c.description)):
+            d[c.description[i][0]] = i
+        idx = [(n, d[n if names[n] is None else names[n]]) for n in names]
+        return d, idx
+
     def getRowsByName(self, c, names, container):
         # c: a database cursor, on which a sql query has bveen carried out
         # names: A mapping: id_desired -> SQL fieldname (SQL fieldname can be None if we want same as id_desired)
 
         # build dict:
-        d = {}
-        for i in range(0, len(c.description)):
-            d[c.description[i][0]] = i
+        d, idx = self.__fieldIndex(c, names)
         rows = c.fetchall()
         for r in rows:
-            a = {}
-            for n in names:
-                sqlfield = n if names[n] is None else names[n]
-                a[n] = r[d[sqlfield]]
-            container.append(a)
+            container.append({n: r[i] for n, i in idx})
         return d, rows
+
+    # same as getRowsByName, but yields the dicts one at a time, fetching
+    # batch_size rows at a time from c (use execute(..., chunked=True) to get
+    # a server-side cursor)
+    def iterRowsByName(self, c, names, batch_size=None):
+        if batch_size is None:
+            batch_size = getattr(settings, "DB_FETCH_BATCH_SIZE", 2000)
+        d, idx = self.__fieldIndex(c, names)
+        while True:
+            rows = c.fetchmany(batch_size)
+            if not rows:
+                break
+            for r in rows:
+                yield {n: r[i] for n, i in idx}
+
+    # inserts rows (sequences of values, in the same order as columns) into
+    # table, batch_size rows per round trip: COPY FROM STDIN on PostgreSQL,
+    # executemany elsewhere. Returns the number of rows inserted.
+    def bulkInsert(self, table, columns, rows, batch_size=None):
+        if batch_size is None:
+            batch_size = getattr(settings, "DB_INSERT_BATCH_SIZE", 1000)
+        table = self.escape_string(table)
+        columns = [self.escape_string(c) for c in columns]
+        debugQuery("bulkInsert", table, columns)
+        n = 0
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        n += self.__insertBatch(cursor, table, columns, batch)
+                        batch = []
+                if batch:
+                    n += self.__insertBatch(cursor, table, columns, batch)
+        return n
+
+    def __insertBatch(self, cursor, table, columns, batch):
+        if self.postgres:
+            buf = io.StringIO()
+            for row in batch:
+                buf.write("\t".join(copyValue(v) for v in row))
+                buf.write("\n")
+            buf.seek(0)
+            # cursor is Django's wrapper, the psycopg2 one has copy_expert
+            cursor.cursor.copy_expert("COPY %s (%s) FROM STDIN" % (table, ", ".join(columns)), buf)
+        else:
+            cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ", ".join(columns), ", ".join(["%s"] * len(columns))), batch)
+        return len(batch)
+
+    # bulkInsert for model instances (e.g. CommentSeen, PageSeen): all the
+    # concrete fields but the auto primary key are written. Like bulk_create,
+    # this doesn't send signals or set the pk on objs.
+    def insertObjects(self, model, objs, batch_size=None):
+        connection = connections[self.dbconf]
+        fields = [f for f in model._meta.concrete_fields if f is not model._meta.auto_field]
+        rows = ([f.get_db_prep_save(f.pre_save(o, True), connection) for f in fields] for o in objs)
+        return self.bulkInsert(model._meta.db_table, [f.column for f in fields], rows, batch_size)
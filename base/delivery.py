@@ -0,0 +1,144 @@
+"""
+delivery.py - Serving PDF files
+
+GET pdf/<id_source> returns the PDF of a source, for users who pass
+auth.canDownloadPDF. Whole files go through FileResponse, which lets the
+server use sendfile (wsgi.file_wrapper). Single byte ranges (Range: bytes=
+a-b, as sent by PDF.js) are answered with 206 from a memory map of the
+file, CHUNK bytes at a time, so the file is never read into memory.
+The ETag is derived from Source.version, so If-None-Match and If-Range
+work across uploads of a new version.
+
+GET pdf/<id_source>/annotated returns the PDF with the comments baked in
+(see export.py), for users who pass auth.canDownloadFileComments.
+
+GET pdf/<id_source>/page/<page>?resolution=<dpi> returns the PNG image of
+a page (see render.py), for users who pass auth.canReadFile. resolution
+is one of RENDER_RESOLUTIONS (the first one by default).
+"""
+import mmap
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.http import (FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+                         HttpResponseNotFound, StreamingHttpResponse)
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
+
+from . import auth
+from . import models as M
+from .export import exportAnnotated
+from .processing import pdfPath
+from .render import renderer
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK = 256 * 1024
+
+
+def etag(id_source, version):
+    return '"pdf-%s-%s"' % (id_source, version)
+
+
+def parseRange(header, size):
+    """(start, end) included, for a single range header; None to send the whole file; False if unsatisfiable"""
+    m = RANGE.match(header.replace(" ", ""))
+    if m is None:
+        # several ranges, or another unit: allowed to ignore it
+        return None
+    first, last = m.groups()
+    if first == "":
+        if last == "" or int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = size - 1 if last == "" else min(int(last), size - 1)
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _chunks(path, start, end):
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        pos = start
+        while pos <= end:
+            n = min(CHUNK, end + 1 - pos)
+            yield m[pos:pos + n]
+            pos += n
+
+
+@require_safe
+def pdf(request, id_source):
+    user = auth.getCkeyInfo(request.COOKIES.get("ckey") or request.GET.get("ckey"))
+    if user is None or not auth.canDownloadPDF(user.id, id_source):
+        return HttpResponseForbidden()
+    version = M.Source.objects.filter(pk=id_source).values_list("version", flat=True).first()
+    path = pdfPath(id_source)
+    if version is None or not os.path.isfile(path):
+        return HttpResponseNotFound()
+    tag = etag(id_source, version)
+    if tag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+        response = HttpResponse(status=304)
+        response["ETag"] = tag
+        return response
+    size = os.path.getsize(path)
+    byte_range = None
+    if "HTTP_RANGE" in request.META and request.META.get("HTTP_IF_RANGE", tag) == tag:
+        byte_range = parseRange(request.META["HTTP_RANGE"], size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */%s" % size
+        return response
+    if request.method == "GET" and "HTTP_RANGE" not in request.META:
+        # only log whole downloads, not each range PDF.js asks for
+        M.FileDownload(user_id=user.id, source_id=id_source, annotated=False).save()
+    if byte_range is None:
+        response = FileResponse(open(path, "rb"), content_type="application/pdf")
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(_chunks(path, start, end), status=206, content_type="application/pdf")
+        response["Content-Range"] = "bytes %s-%s/%s" % (start, end, size)
+        response["Content-Length"] = str(end - start + 1)
+    response["ETag"] = tag
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+@require_safe
+def annotatedPdf(request, id_source):
+    user = auth.getCkeyInfo(request.COOKIES.get("ckey") or request.GET.get("ckey"))
+    if user is None or not auth.canDownloadFileComments(user.id, id_source):
+        return HttpResponseForbidden()
+    if not os.path.isfile(pdfPath(id_source)):
+        return HttpResponseNotFound()
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        exportAnnotated(id_source, tmp.name, user.id)
+        # the name goes away with tmp, the file when FileResponse closes it
+        # (opened from a descriptor, so that FileResponse doesn't stat the name)
+        out = os.fdopen(os.open(tmp.name, os.O_RDONLY), "rb")
+    M.FileDownload(user_id=user.id, source_id=id_source, annotated=True).save()
+    response = FileResponse(out, content_type="application/pdf", as_attachment=True,
+                            filename="%s-annotated.pdf" % (id_source, ))
+    response["Content-Length"] = str(os.fstat(out.fileno()).st_size)
+    return response
+
+
+@require_safe
+def page(request, id_source, page):
+    user = auth.getCkeyInfo(request.COOKIES.get("ckey") or request.GET.get("ckey"))
+    if user is None or not auth.canReadFile(user.id, id_source, request):
+        return HttpResponseForbidden()
+    resolutions = getattr(settings, "RENDER_RESOLUTIONS", (72, 150))
+    try:
+        resolution = int(request.GET.get("resolution", resolutions[0]))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if resolution not in resolutions:
+        return HttpResponseBadRequest()
+    if not os.path.isfile(pdfPath(id_source)):
+        return HttpResponseNotFound()
+    path = renderer.page(id_source, page, resolution)
+    if path is None:
+        return HttpResponseNotFound()
+    return FileResponse(open(path, "rb"), content_type="image/png")
@@ -0,0 +1,60 @@
+"""
+export.py - PDFs with the comments baked in
+
+exportAnnotated(id_source, dest, uid) copies the PDF of a source to the
+path dest with one rectangle annotation per location, whose note holds
+the staff and class comments of that thread that are neither deleted nor
+moderated. Only the locations of the ensembles uid administrates are
+exported: a source can be shared by several classes. The locations and comments
+are streamed from the database in page order (Db.iterRows, server-side
+cursor on PostgreSQL) and drawn one page at a time, so only the comments
+of the current page are in memory. A PDF can only be written once all
+its pages are done, so the whole export runs before the first byte is
+sent: the output goes to a temporary file that delivery.py then streams
+to the client. (PyMuPDF writes file objects that have a name to that
+name, behind the back of the object, hence a path.)
+
+Requires PyMuPDF (pip install pymupdf).
+"""
+from contextlib import closing, nullcontext
+from itertools import groupby
+
+from . import models as M
+from .db import Db
+from .perms import resolver
+from .processing import pdfPath
+
+ANNOTATIONS_QUERY = """
+SELECT l.page, l.id, l.x, l.y, l.w, l.h, c.body
+FROM base_location l JOIN base_comment c ON c.location_id = l.id
+WHERE l.source_id = ? AND l.ensemble_id IN (%s) AND c.deleted = ? AND c.moderated = ? AND c.type IN (2, 3)
+ORDER BY l.page, l.id, c.ctime, c.id"""
+
+
+def exportAnnotated(id_source, dest, uid):
+    import fitz  # PyMuPDF
+
+    w, h = M.Source.objects.values_list("w", "h").get(pk=id_source)
+    eids = sorted(eid for eid, m in resolver.memberships(uid).items() if m.admin)
+    if eids:
+        # closing: gives the cursor and the connection back if the export fails halfway
+        rows = closing(Db().iterRows(ANNOTATIONS_QUERY % ", ".join(["?"] * len(eids)),
+                                     [id_source] + eids + [False, False]))
+    else:
+        # just a copy
+        rows = nullcontext(())
+    with rows as rows, fitz.open(pdfPath(id_source)) as doc:
+        for page_number, page_rows in groupby(rows, key=lambda r: r[0]):
+            if not 1 <= page_number <= doc.page_count:
+                continue
+            page = doc[page_number - 1]
+            # Location coordinates are in the units of Source.w/h
+            sx = page.rect.width / w if w else 1
+            sy = page.rect.height / h if h else 1
+            for _, thread in groupby(page_rows, key=lambda r: r[1]):
+                thread = list(thread)
+                _, _, x, y, lw, lh, _ = thread[0]
+                annot = page.add_rect_annot(fitz.Rect(x * sx, y * sy, (x + lw) * sx, (y + lh) * sy))
+                annot.set_info(content="\n\n".join(r[6] or "" for r in thread))
+                annot.update()
+        doc.save(dest, garbage=1, deflate=True)
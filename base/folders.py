@@ -0,0 +1,172 @@
+"""
+folders.py - Queries on the Folder hierarchy
+
+ancestors, descendants and isDirOrParent each run a single recursive CTE
+instead of following Folder.parent one query per level.
+
+When FOLDER_TREE_CACHE is on, the parent links of each ensemble are also
+kept in memory (loaded with one query per ensemble) and kept up to date
+from signals.py when folders are created, moved or deleted, so that these
+questions don't hit the database at all. Each ensemble expires after
+FOLDER_TREE_CACHE_TTL seconds, to pick up the moves made by other
+processes.
+"""
+import threading
+
+from django.conf import settings
+
+from . import models as M
+from .db import Db
+from .perms import TTLCache
+
+# the hierarchy should be a tree, but nothing in the database enforces it:
+# the queries stop after MAX_DEPTH levels (or when rows repeat) on a cycle
+MAX_DEPTH = 100
+
+ANCESTORS_QUERY = """
+WITH RECURSIVE anc(id, parent_id, depth) AS (
+    SELECT id, parent_id, 0 FROM base_folder WHERE id = ?
+    UNION ALL
+    SELECT f.id, f.parent_id, anc.depth + 1 FROM base_folder f JOIN anc ON f.id = anc.parent_id
+    WHERE anc.depth < %d
+)
+SELECT id FROM anc ORDER BY depth""" % MAX_DEPTH
+
+DESCENDANTS_QUERY = """
+WITH RECURSIVE sub(id) AS (
+    SELECT id FROM base_folder WHERE id = ?
+    UNION
+    SELECT f.id FROM base_folder f JOIN sub ON f.parent_id = sub.id
+)
+SELECT id FROM sub"""
+
+IS_INSIDE_QUERY = """
+WITH RECURSIVE anc(id, parent_id) AS (
+    SELECT id, parent_id FROM base_folder WHERE id = ?
+    UNION
+    SELECT f.id, f.parent_id FROM base_folder f JOIN anc ON f.id = anc.parent_id
+)
+SELECT COUNT(*) FROM anc WHERE id = ?"""
+
+
+class FolderTree:
+    """
+    parent links of the folders of each ensemble, loaded on demand. Kept up
+    to date by signals.py for the changes made by this process; the changes
+    made by other processes are seen when the ensemble expires (after ttl
+    seconds).
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        if ttl is None:
+            ttl = getattr(settings, "FOLDER_TREE_CACHE_TTL", 30)
+        if maxsize is None:
+            maxsize = getattr(settings, "FOLDER_TREE_CACHE_SIZE", 1000)
+        self._parents = TTLCache(ttl, maxsize)  # ensemble_id -> {folder_id: parent_id}
+        self._ensembles = {}  # folder_id -> ensemble_id
+        self._lock = threading.Lock()
+
+    def _load(self, eid):
+        parents = dict(M.Folder.objects.filter(ensemble_id=eid).values_list("id", "parent_id"))
+        with self._lock:
+            cached = self._parents.get(eid)
+            if cached is None:
+                self._parents.set(eid, parents)
+                for fid in parents:
+                    self._ensembles[fid] = eid
+                cached = parents
+            return dict(cached)
+
+    def parents(self, id_folder):
+        """
+        {folder_id: parent_id} for the ensemble of id_folder (a copy), None
+        if there's no such folder
+        """
+        with self._lock:
+            eid = self._ensembles.get(id_folder)
+            if eid is not None:
+                parents = self._parents.get(eid)
+                if parents is not None:
+                    return dict(parents)
+        eid = M.Folder.objects.filter(pk=id_folder).values_list("ensemble_id", flat=True).first()
+        if eid is None:
+            return None
+        return self._load(eid)
+
+    def folderSaved(self, id_folder, eid, id_parent):
+        with self._lock:
+            old_eid = self._ensembles.pop(id_folder, None)
+            if old_eid is not None:
+                parents = self._parents.get(old_eid)
+                if parents is not None:
+                    parents.pop(id_folder, None)
+            parents = self._parents.get(eid)
+            if parents is not None:
+                parents[id_folder] = id_parent
+                self._ensembles[id_folder] = eid
+
+    def folderDeleted(self, id_folder):
+        with self._lock:
+            eid = self._ensembles.pop(id_folder, None)
+            if eid is not None:
+                parents = self._parents.get(eid)
+                if parents is not None:
+                    parents.pop(id_folder, None)
+
+    def clear(self):
+        with self._lock:
+            self._parents.clear()
+            self._ensembles.clear()
+
+
+tree = FolderTree()
+
+
+def _cached():
+    return getattr(settings, "FOLDER_TREE_CACHE", False)
+
+
+def ancestors(id_folder):
+    """ids from id_folder (included) up to its root folder"""
+    id_folder = int(id_folder)
+    if _cached():
+        parents = tree.parents(id_folder)
+        if parents is None:
+            return []
+        out = [id_folder]
+        while parents.get(out[-1]) is not None and parents[out[-1]] not in out:
+            out.append(parents[out[-1]])
+        return out
+    return [r[0] for r in Db().getRows(ANCESTORS_QUERY, (id_folder,), prepare=True)]
+
+
+def descendants(id_folder):
+    """ids of id_folder (included) and of all the folders it contains, at any depth"""
+    id_folder = int(id_folder)
+    if _cached():
+        parents = tree.parents(id_folder)
+        if parents is None:
+            return []
+        children = {}
+        for fid, pid in parents.items():
+            children.setdefault(pid, []).append(fid)
+        out = [id_folder]
+        seen = {id_folder}
+        for fid in out:
+            for child in children.get(fid, ()):
+                if child not in seen:
+                    seen.add(child)
+                    out.append(child)
+        return out
+    return [r[0] for r in Db().getRows(DESCENDANTS_QUERY, (id_folder,), prepare=True)]
+
+
+def isDirOrParent(id_a, id_b):
+    """true if a == b or a contains b, at any depth"""
+    if id_a is None or id_b is None:
+        # None is the top level, which isn't a folder
+        return False
+    id_a, id_b = int(id_a), int(id_b)
+    if _cached():
+        return id_a in ancestors(id_b)
+    return Db().getVal(IS_INSIDE_QUERY, (id_b, id_a), prepare=True) > 0
@@ -0,0 +1,120 @@
+"""
+guests.py - Pool of pre-created guest accounts
+
+Creating a guest (User + GuestHistory) on the request of every anonymous
+visitor is slow when a class link is posted to many students at once, so
+guests are created GUEST_POOL_BATCH at a time in a background thread and
+handed out by claim(). Pooled guests are regular guest users whose
+GuestHistory.t_start is still NULL (found through a partial index): claim()
+sets it, so that a guest is never handed out twice, even across processes.
+Where the database supports it (PostgreSQL), claim() locks the oldest
+unclaimed row with FOR UPDATE SKIP LOCKED, so that concurrent claims each
+get a different row instead of all racing for the first one; elsewhere it
+uses a conditional UPDATE and retries.
+The pool is refilled up to GUEST_POOL_SIZE when fewer than
+GUEST_POOL_MIN guests are left.
+"""
+import logging
+import secrets
+import string
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import models as M
+
+KEY_CHARS = string.ascii_letters + string.digits
+
+
+def newKey(length=20):
+    return "".join(secrets.choice(KEY_CHARS) for _ in range(length))
+
+
+def newGuest():
+    """an unsaved guest User, same as auth.createGuest would make"""
+    key = newKey()
+    o = M.User(email="guest_%s@nb.test" % (key, ), confkey=key, valid=False, guest=True)
+    o.set_unusable_password()
+    return o
+
+
+class GuestPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._available = None  # estimate, None until counted
+        self._refilling = False
+
+    def size(self):
+        return getattr(settings, "GUEST_POOL_SIZE", 0)
+
+    def claim(self):
+        """returns a guest User that nobody else got, or None if the pool is empty"""
+        if self.size() <= 0:
+            return None
+        if connection.features.has_select_for_update_skip_locked:
+            user = self._claimLocked()
+        else:
+            user = self._claimUpdate()
+        with self._lock:
+            if self._available is not None:
+                self._available = max(self._available - 1, 0)
+        self.refillMaybe()
+        return user
+
+    def _claimLocked(self):
+        with transaction.atomic():
+            row = M.GuestHistory.objects.select_for_update(skip_locked=True).filter(
+                t_start=None, t_end=None).order_by("id").values_list("id", "user_id").first()
+            if row is None:
+                return None
+            M.GuestHistory.objects.filter(pk=row[0]).update(t_start=datetime.now())
+        return M.User.objects.get(pk=row[1])
+
+    def _claimUpdate(self):
+        for _ in range(5):
+            row = M.GuestHistory.objects.filter(t_start=None, t_end=None).order_by("id").values_list(
+                "id", "user_id").first()
+            if row is None:
+                return None
+            # only one process gets to flip t_start from NULL
+            if M.GuestHistory.objects.filter(pk=row[0], t_start=None).update(t_start=datetime.now()):
+                return M.User.objects.get(pk=row[1])
+        return None
+
+    def refillMaybe(self):
+        with self._lock:
+            if self._refilling:
+                return
+            if self._available is not None and self._available >= getattr(settings, "GUEST_POOL_MIN", 100):
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, name="guest-pool", daemon=True).start()
+
+    def _refill(self):
+        try:
+            available = M.GuestHistory.objects.filter(t_start=None, t_end=None).count()
+            batch = getattr(settings, "GUEST_POOL_BATCH", 200)
+            while available < self.size():
+                n = min(batch, self.size() - available)
+                self.createGuests(n)
+                available += n
+            with self._lock:
+                self._available = available
+        except Exception:
+            logging.exception("[guests] could not refill the guest pool")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def createGuests(self, n):
+        """creates n unclaimed guests, with one insert for the users and one for their history"""
+        users = [newGuest() for _ in range(n)]
+        M.User.objects.bulk_create(users)
+        # bulk_create doesn't set the pks on every backend
+        ids = M.User.objects.filter(confkey__in=[u.confkey for u in users]).values_list("id", flat=True)
+        M.GuestHistory.objects.bulk_create([M.GuestHistory(user_id=uid, t_start=None) for uid in ids])
+
+
+pool = GuestPool()
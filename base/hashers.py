@@ -0,0 +1,87 @@
+"""
+hashers.py - Password hashing for User.authenticate and User.set_password
+
+User.saltedhash is either a legacy hex SHA-512 of password + salt, or
+"<algorithm>$<params>$<hash>" for the hashers registered here. New
+passwords use the PASSWORD_HASHER algorithm, and legacy or weaker hashes
+are replaced by it the next time the user logs in successfully.
+Hashes are always compared in constant time.
+"""
+import base64
+import hashlib
+import hmac
+
+from django.conf import settings
+
+
+def _bytes(s):
+    return s.encode("ascii", "xmlcharrefreplace")
+
+
+class SHA512Hasher:
+    """the original scheme: one round of SHA-512 over password + salt"""
+    algorithm = "sha512"
+
+    def encode(self, password, salt):
+        return hashlib.sha512(_bytes(password) + _bytes(salt)).hexdigest()
+
+    def verify(self, password, salt, encoded):
+        return hmac.compare_digest(_bytes(self.encode(password, salt)), _bytes(encoded))
+
+    def needsUpgrade(self, encoded):
+        return False
+
+
+class PBKDF2Hasher:
+    algorithm = "pbkdf2_sha256"
+
+    def iterations(self):
+        return getattr(settings, "PASSWORD_HASH_ITERATIONS", 100000)
+
+    def encode(self, password, salt, iterations=None):
+        if iterations is None:
+            iterations = self.iterations()
+        h = hashlib.pbkdf2_hmac("sha256", _bytes(password), _bytes(salt), iterations)
+        return "%s$%d$%s" % (self.algorithm, iterations, base64.b64encode(h).decode("ascii"))
+
+    def verify(self, password, salt, encoded):
+        iterations = int(encoded.split("$", 2)[1])
+        return hmac.compare_digest(_bytes(self.encode(password, salt, iterations)), _bytes(encoded))
+
+    def needsUpgrade(self, encoded):
+        return int(encoded.split("$", 2)[1]) != self.iterations()
+
+
+_hashers = {}
+
+
+def register(hasher):
+    _hashers[hasher.algorithm] = hasher
+
+
+register(SHA512Hasher())
+register(PBKDF2Hasher())
+
+
+def getHasher(encoded=None):
+    """the hasher that produced encoded, or the default one if encoded is None"""
+    if encoded is None:
+        return _hashers[getattr(settings, "PASSWORD_HASHER", PBKDF2Hasher.algorithm)]
+    if "$" not in encoded:
+        return _hashers[SHA512Hasher.algorithm]
+    return _hashers[encoded.split("$", 1)[0]]
+
+
+def makePassword(password, salt):
+    return getHasher().encode(password, salt)
+
+
+def checkPassword(password, salt, encoded):
+    """returns (password is correct, encoded needs to be replaced with makePassword)"""
+    if encoded is None or salt is None:
+        return False, False
+    hasher = getHasher(encoded)
+    if not hasher.verify(password, salt, encoded):
+        return False, False
+    default = getHasher()
+    return True, hasher is not default or hasher.needsUpgrade(encoded)
@@ -0,0 +1,98 @@
+"""
+benchmark - Times a few hot code paths
+
+Each benchmark runs its functions --number times and reports the mean time
+of one call, so that a change to one of those paths can be compared before
+and after. Run it against a copy of the production database: the numbers
+on an empty SQLite one say little about the queries. Each benchmark runs
+in a transaction that is rolled back, so the rows it creates go away.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from base import auth, db, folders
+from base import models as M
+from base.perms import resolver
+
+
+def timeit(f, number):
+    t0 = time.perf_counter()
+    for _ in range(number):
+        f()
+    return (time.perf_counter() - t0) / number
+
+
+def placeholders(number):
+    # the rewrite of the ? placeholders, cached (as Db.execute does) or not
+    qry = folders.ANCESTORS_QUERY
+    return [
+        ("toPyformat", lambda: db.toPyformat(qry)),
+        ("toPyformat, uncached", lambda: db.toPyformat.__wrapped__(qry)),
+        ("toPrepared", lambda: db.toPrepared(qry)),
+        ("toPrepared, uncached", lambda: db.toPrepared.__wrapped__(qry)),
+    ]
+
+
+def prepared(number):
+    # a hot query, planned on every call or PREPAREd once per connection
+    # (the same thing on anything but PostgreSQL)
+    d = db.Db()
+    return [
+        ("getRows", lambda: d.getRows(folders.ANCESTORS_QUERY, (0,))),
+        ("getRows, prepared", lambda: d.getRows(folders.ANCESTORS_QUERY, (0,), prepare=True)),
+    ]
+
+
+def batchchecks(number):
+    # the batch permission checks against looping over the checks they
+    # batch, for the sources, comments and locations of a 100 source class
+    user = M.User.objects.create(email="benchmark@example.com", valid=True)
+    ensemble = M.Ensemble.objects.create(name="benchmark")
+    M.Membership.objects.create(user=user, ensemble=ensemble, admin=True)
+    sources, locations, comments = [], [], []
+    for _ in range(100):
+        source = M.Source.objects.create()
+        M.Ownership.objects.create(source=source, ensemble=ensemble)
+        location = M.Location.objects.create(source=source, ensemble=ensemble, x=0, y=0, w=10, h=10, page=1)
+        sources.append(source.id)
+        locations.append(location.id)
+        comments.append(M.Comment.objects.create(location=location, author=user, type=3).id)
+    resolver.clear()
+    return [
+        ("readable_sources", lambda: auth.readable_sources(user.id, sources)),
+        ("canReadFile loop", lambda: [i for i in sources if auth.canReadFile(user.id, i)]),
+        ("labelable_comments", lambda: auth.labelable_comments(user.id, comments)),
+        ("canLabelComment loop", lambda: [i for i in comments if auth.canLabelComment(user.id, i)]),
+        ("administrable_locations", lambda: auth.administrable_locations(user.id, locations)),
+        ("canAdministrateLocation loop", lambda: [i for i in locations if auth.canAdministrateLocation(user.id, i)]),
+    ]
+
+
+BENCHMARKS = {
+    "batchchecks": batchchecks,
+    "placeholders": placeholders,
+    "prepared": prepared,
+}
+
+
+class Command(BaseCommand):
+    help = "Times a few hot code paths (%s)" % ", ".join(sorted(BENCHMARKS))
+
+    def add_arguments(self, parser):
+        parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+        parser.add_argument("--number", type=int, default=1000, help="calls per function")
+
+    def handle(self, *args, **options):
+        names = options["names"] or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("unknown benchmark %s (choose from %s)" % (name, ", ".join(sorted(BENCHMARKS))))
+        for name in names:
+            self.stdout.write(name)
+            with transaction.atomic():
+                for label, f in BENCHMARKS[name](options["number"]):
+                    f()  # warm up (caches, connection, prepared statement)
+                    self.stdout.write("  %-30s %10.1f us" % (label, timeit(f, options["number"]) * 1e6))
+                transaction.set_rollback(True)
@@ -0,0 +1,66 @@
+"""
+explainqueries - Reports the queries of a log that scan large tables
+
+The log is a file of SQL statements, each one ending with a ";" at the end
+of a line (lines starting with "--" are ignored). Placeholders (? or %s)
+are replaced with '1' since the arguments aren't known: queries for which
+that isn't a valid value are reported as not explained.
+"""
+import re
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from base.db import POSTGRES_ENGINES
+
+PLACEHOLDER = re.compile(r"\?|%s")
+# "Seq Scan on base_comment c" (PostgreSQL), "SCAN base_comment" or
+# "SCAN TABLE base_comment" (SQLite)
+SEQ_SCAN = re.compile(r"(?:Seq Scan on|\bSCAN(?: TABLE)?) (\w+)\b(?! USING)")
+
+
+def readQueries(f):
+    qry = []
+    for line in f:
+        if line.lstrip().startswith("--"):
+            continue
+        qry.append(line)
+        if line.rstrip().endswith(";"):
+            yield "".join(qry).strip().rstrip(";")
+            qry = []
+    if "".join(qry).strip():
+        yield "".join(qry).strip()
+
+
+class Command(BaseCommand):
+    help = "Runs EXPLAIN on each query of a log and reports sequential scans on large tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("logfile")
+        parser.add_argument("--database", default="default")
+        parser.add_argument("--min-rows", type=int, default=10000,
+                            help="only report scans on tables with at least that many rows")
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        postgres = connection.settings_dict["ENGINE"] in POSTGRES_ENGINES
+        explain = "EXPLAIN " if postgres else "EXPLAIN QUERY PLAN "
+        sizes = {}
+        n = 0
+        with open(options["logfile"]) as f, connection.cursor() as cursor:
+            for i, qry in enumerate(readQueries(f), 1):
+                try:
+                    cursor.execute(explain + PLACEHOLDER.sub("'1'", qry))
+                    plan = "\n".join(str(row[-1]) for row in cursor.fetchall())
+                except Exception as e:
+                    self.stderr.write("query %s: not explained (%s)" % (i, e))
+                    continue
+                for table in sorted(set(SEQ_SCAN.findall(plan))):
+                    if table not in sizes:
+                        cursor.execute("SELECT COUNT(*) FROM %s" % connection.ops.quote_name(table))
+                        sizes[table] = cursor.fetchone()[0]
+                    if sizes[table] >= options["min_rows"]:
+                        n += 1
+                        self.stdout.write("query %s: sequential scan on %s (%s rows)\n    %s" % (
+                            i, table, sizes[table], " ".join(qry.split())))
+        self.stdout.write("%s sequential scan(s) on large tables" % n)
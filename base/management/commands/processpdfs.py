@@ -0,0 +1,24 @@
+"""
+processpdfs - Runs the Processqueue workers (see base/processing.py)
+"""
+from django.core.management.base import BaseCommand
+
+from base import processing
+
+
+class Command(BaseCommand):
+    help = "Processes the PDFs waiting in Processqueue with a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+        parser.add_argument("--once", action="store_true", help="exit when the queue is empty")
+        parser.add_argument("--stats", action="store_true",
+                            help="only print the queue depth, latency and throughput of the last hour")
+
+    def handle(self, *args, **options):
+        if options["stats"]:
+            s = processing.stats()
+            self.stdout.write("queued: %(depth)s, running: %(running)s, failed: %(failed)s, mean wait: %(wait)ss, "
+                              "mean processing: %(run)ss, completed/min: %(per_minute).2f" % s)
+            return
+        processing.run(workers=options["workers"], once=options["once"])
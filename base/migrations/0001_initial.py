@@ -0,0 +1,496 @@
+# Generated by Django 3.1.14 on 2026-10-17 18:05
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Comment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(db_index=True, default=datetime.datetime.now)),
+                ('body', models.TextField(blank=True, null=True)),
+                ('type', models.IntegerField(choices=[(1, 'Private'), (2, 'Staff'), (3, 'Class'), (4, 'Tag Private')])),
+                ('signed', models.BooleanField(default=True)),
+                ('deleted', models.BooleanField(default=False)),
+                ('moderated', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DefaultSetting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1023)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('value', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Ensemble',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.CharField(default='No description available', max_length=255)),
+                ('allow_staffonly', models.BooleanField(default=True, verbose_name="Allow users to write 'staff-only' comments")),
+                ('allow_anonymous', models.BooleanField(default=True, verbose_name='Allow users to write anonymous comments')),
+                ('allow_tag_private', models.BooleanField(default=True, verbose_name='Allow users to make comments private to tagged users only')),
+                ('allow_guest', models.BooleanField(default=False, verbose_name='Allow guests (i.e. non-members) to access the site')),
+                ('invitekey', models.CharField(blank=True, max_length=63, null=True)),
+                ('use_invitekey', models.BooleanField(default=True, verbose_name="Allow users who have the 'subscribe link' to register by themselves")),
+                ('allow_download', models.BooleanField(default=True, verbose_name='Allow users to download the PDFs')),
+                ('allow_ondemand', models.BooleanField(default=False, verbose_name='Allow users to add any PDF accessible on the internet by pointing to its URL')),
+                ('default_pause', models.BooleanField(default=False, verbose_name='Pause on staff Video comments by default')),
+                ('section_assignment', models.IntegerField(choices=[(1, 'NULL'), (2, 'RANDOM')], default=1, null=True)),
+                ('metadata', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Folder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+                ('parent', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='base.folder')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LabelCategory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('visibility', models.IntegerField(choices=[(1, 'USER'), (2, 'ADMIN'), (3, 'SUPERADMIN')], default=2)),
+                ('scope', models.IntegerField(choices=[(1, 'COMMENT'), (2, 'THREAD')], default=1)),
+                ('pointscale', models.IntegerField()),
+                ('name', models.CharField(max_length=1024)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Location',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(default=1)),
+                ('x', models.IntegerField()),
+                ('y', models.IntegerField()),
+                ('w', models.IntegerField()),
+                ('h', models.IntegerField()),
+                ('page', models.IntegerField()),
+                ('duration', models.IntegerField(null=True)),
+                ('is_title', models.BooleanField(default=False)),
+                ('pause', models.BooleanField(default=False)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(max_length=127)),
+                ('atime', models.DateTimeField(default=datetime.datetime.now, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Source',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(default='untitled', max_length=255)),
+                ('numpages', models.IntegerField(default=0)),
+                ('w', models.IntegerField(default=0)),
+                ('h', models.IntegerField(default=0)),
+                ('rotation', models.IntegerField(default=0)),
+                ('version', models.IntegerField(default=0)),
+                ('type', models.IntegerField(choices=[(1, 'PDF'), (2, 'YOUTUBE'), (3, 'HTML5VIDEO'), (4, 'HTML5')], default=1)),
+                ('x0', models.IntegerField(default=0)),
+                ('y0', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=63, unique=True)),
+                ('firstname', models.CharField(blank=True, max_length=63, null=True)),
+                ('lastname', models.CharField(blank=True, max_length=63, null=True)),
+                ('pseudonym', models.CharField(blank=True, max_length=63, null=True)),
+                ('password', models.CharField(blank=True, max_length=63, null=True)),
+                ('salt', models.CharField(max_length=32, null=True)),
+                ('saltedhash', models.CharField(max_length=128, null=True)),
+                ('confkey', models.CharField(blank=True, max_length=63, null=True)),
+                ('guest', models.BooleanField(default=False)),
+                ('valid', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='YoutubeInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(blank=True, max_length=255, null=True)),
+                ('source', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserSetting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField()),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('setting', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.defaultsetting')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThreadMarkHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.IntegerField(choices=[(1, 'question'), (2, 'star'), (3, 'summarize')])),
+                ('active', models.BooleanField(default=True)),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('comment', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.comment')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.location')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThreadMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.IntegerField(choices=[(1, 'question'), (2, 'star'), (3, 'summarize')])),
+                ('active', models.BooleanField(default=True)),
+                ('ctime', models.DateTimeField(db_index=True, default=datetime.datetime.now)),
+                ('comment', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.comment')),
+                ('location', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.location')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.IntegerField(choices=[(1, 'Individual')])),
+                ('last_reminder', models.DateTimeField(null=True)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('individual', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SourceVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(default='untitled', max_length=255)),
+                ('numpages', models.IntegerField(default=0)),
+                ('w', models.IntegerField(default=0)),
+                ('h', models.IntegerField(default=0)),
+                ('rotation', models.IntegerField(default=0)),
+                ('version', models.IntegerField(default=0)),
+                ('published', models.DateTimeField()),
+                ('submittedby', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='submittedby',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user'),
+        ),
+        migrations.CreateModel(
+            name='SettingLabel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField()),
+                ('label', models.TextField()),
+                ('setting', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.defaultsetting')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Session',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('lastactivity', models.DateTimeField(default=datetime.datetime.now, null=True)),
+                ('ip', models.CharField(blank=True, max_length=63, null=True)),
+                ('clienttime', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Section',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReplyRating',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(db_index=True, default=datetime.datetime.now)),
+                ('status', models.IntegerField(choices=[(1, 'unresolved'), (2, 'resolved'), (3, 'thanks')])),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('threadmark', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.threadmark')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Processqueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('submitted', models.DateTimeField(default=datetime.datetime.now)),
+                ('started', models.DateTimeField(null=True)),
+                ('completed', models.DateTimeField(null=True)),
+                ('source', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PageSeen',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.IntegerField()),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('session', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.session')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Ownership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('published', models.DateTimeField(db_index=True, default=datetime.datetime.now)),
+                ('deleted', models.BooleanField(default=False)),
+                ('assignment', models.BooleanField(default=False)),
+                ('due', models.DateTimeField(default=datetime.datetime.now, null=True)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+                ('folder', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.folder')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OnDemandInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(blank=True, max_length=2048, null=True)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+                ('source', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Membership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin', models.BooleanField(default=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('guest', models.BooleanField(default=False)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+                ('section', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.section')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Mark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.IntegerField(choices=[(1, 'answerplease'), (3, 'approve'), (5, 'reject'), (7, 'favorite'), (9, 'hide')])),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='section',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.section'),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='source',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source'),
+        ),
+        migrations.CreateModel(
+            name='Landing',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('ip', models.CharField(blank=True, max_length=63, null=True)),
+                ('client', models.CharField(blank=True, max_length=1023, null=True)),
+                ('referer', models.CharField(blank=True, max_length=1023, null=True)),
+                ('path', models.CharField(blank=True, max_length=1023, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LabelCategoryCaption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grade', models.IntegerField()),
+                ('caption', models.CharField(max_length=127)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.labelcategory')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Invite',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('admin', models.BooleanField(default=False)),
+                ('ctime', models.DateTimeField(db_index=True, default=datetime.datetime.now, null=True)),
+                ('ensemble', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.ensemble')),
+                ('section', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='base.section')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Idle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('t1', models.DateTimeField()),
+                ('t2', models.DateTimeField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.session')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HTML5Location',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path1', models.CharField(blank=True, max_length=2048, null=True)),
+                ('path2', models.CharField(blank=True, max_length=2048, null=True)),
+                ('offset1', models.IntegerField()),
+                ('offset2', models.IntegerField()),
+                ('location', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='base.location')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HTML5Info',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(blank=True, max_length=2048, null=True)),
+                ('source', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GuestLoginHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now, null=True)),
+                ('guest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='u1', to='base.user')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='u2', to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GuestHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('t_start', models.DateTimeField(default=datetime.datetime.now, null=True)),
+                ('t_end', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FileDownload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('annotated', models.BooleanField(default=False)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommentSeen',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('session', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.session')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommentLabelHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('grade', models.IntegerField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.labelcategory')),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('grader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CommentLabel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('grade', models.IntegerField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.labelcategory')),
+                ('comment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.comment')),
+                ('grader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='author',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='location',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.location'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='parent',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.comment'),
+        ),
+        migrations.CreateModel(
+            name='AssignmentGradeHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('grade', models.IntegerField()),
+                ('grader', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='g_grade_h', to='base.user')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='u_grade_h', to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AssignmentGrade',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('grade', models.IntegerField()),
+                ('grader', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='g_grade', to='base.user')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='u_grade', to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnalyticsVisit',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AnalyticsClick',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ctime', models.DateTimeField(default=datetime.datetime.now)),
+                ('control', models.CharField(max_length=30)),
+                ('value', models.CharField(max_length=30)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='base.user')),
+            ],
+        ),
+    ]
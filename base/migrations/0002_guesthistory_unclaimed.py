@@ -0,0 +1,17 @@
+# Generated by Django 3.1.14 on 2026-10-17 17:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='guesthistory',
+            index=models.Index(condition=models.Q(('t_end', None), ('t_start', None)), fields=['id'], name='guesthistory_unclaimed'),
+        ),
+    ]
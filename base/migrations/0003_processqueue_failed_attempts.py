@@ -0,0 +1,23 @@
+# Generated by Django 3.1.14 on 2026-10-17 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_guesthistory_unclaimed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processqueue',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processqueue',
+            name='failed',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
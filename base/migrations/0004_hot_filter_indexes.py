@@ -0,0 +1,37 @@
+# Generated by Django 3.1.14 on 2026-10-17 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_processqueue_failed_attempts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['location', 'deleted', 'parent'], name='comment_loc_del_parent'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(parent=None), fields=['location'], name='comment_root'),
+        ),
+        migrations.AddIndex(
+            model_name='commentseen',
+            index=models.Index(fields=['user', 'comment'], name='commentseen_user_comment'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['source', 'page'], name='location_source_page'),
+        ),
+        migrations.AddIndex(
+            model_name='membership',
+            index=models.Index(fields=['user', 'ensemble', 'deleted'], name='membership_user_ens_del'),
+        ),
+        migrations.AddIndex(
+            model_name='ownership',
+            index=models.Index(fields=['source', 'deleted'], name='ownership_source_del'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.14 on 2026-10-17 18:06
+
+import datetime
+from django.db import migrations, models
+from django.db.models import F
+
+
+# Existing rows haven't changed since they were created
+def backfill(apps, schema_editor):
+    for name in ("Comment", "ReplyRating", "ThreadMark"):
+        apps.get_model("base", name).objects.update(mtime=F("ctime"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='mtime',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.now),
+        ),
+        migrations.AddField(
+            model_name='replyrating',
+            name='mtime',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.now),
+        ),
+        migrations.AddField(
+            model_name='threadmark',
+            name='mtime',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime.now),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
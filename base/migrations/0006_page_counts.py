@@ -0,0 +1,39 @@
+# Generated by Django 3.1.14 on 2026-10-17 18:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_comment_mtime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageSeenCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.IntegerField()),
+                ('seen', models.IntegerField(default=0)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.user')),
+            ],
+            options={
+                'unique_together': {('user', 'source', 'page')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PageCommentCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.IntegerField()),
+                ('total', models.IntegerField(default=0)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='base.source')),
+            ],
+            options={
+                'unique_together': {('source', 'page')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+# checkUser looks users up with email__iexact, which is UPPER(email) =
+# UPPER(...) on PostgreSQL: the unique index on email can't serve it
+CREATE = 'CREATE INDEX IF NOT EXISTS base_user_email_upper ON base_user (UPPER("email"::text))'
+DROP = "DROP INDEX IF EXISTS base_user_email_upper"
+
+
+def forwards(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(CREATE)
+
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_page_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
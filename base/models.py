@@ -8,9 +8,10 @@ import time
 import pytz
 import calendar
 from django.utils import timezone
-import hashlib
 import uuid
 
+from . import hashers
+
 
 class User(models.Model):
     email = EmailField(max_length=63, unique=True)
@@ -31,19 +32,27 @@ class User(models.Model):
         return "%s %s: %s %s <%s>" % (self.__class__.__name__, self.id,  self.firstname, self.lastname, self.email)
 
     # Returns 'True' if password is correct, 'False' othrewise
+    # Hashes made with an old scheme are upgraded (and saved) on success
     def authenticate(self, password):
-        user_hash = hashlib.sha512(password.encode(
-            'ascii', 'xmlcharrefreplace') + self.salt.encode('ascii', 'xmlcharrefreplace')).hexdigest()
-        return (self.saltedhash == user_hash)
+        ok, upgrade = hashers.checkPassword(password, self.salt, self.saltedhash)
+        if ok and upgrade:
+            self.saltedhash = hashers.makePassword(password, self.salt)
+            self.save(update_fields=["saltedhash"])
+        return ok
 
     # Updates 'salt' and 'saltedhash' to correspond to new password
     # this method does notcall 'save'
     def set_password(self, password):
         self.salt = uuid.uuid4().hex
-        self.saltedhash = hashlib.sha512(password.encode(
-            'ascii', 'xmlcharrefreplace') + self.salt.encode('ascii', 'xmlcharrefreplace')).hexdigest()
+        self.saltedhash = hashers.makePassword(password, self.salt)
         return
 
+    # No password will ever match (used for guests, who log in with their
+    # confkey); cheaper than hashing a random one. Doesn't call 'save' either
+    def set_unusable_password(self):
+        self.salt = None
+        self.saltedhash = None
+
 
 # old: ensemble
 class Ensemble(models.Model):
@@ -131,6 +140,9 @@ class Membership(models.Model):
     def __unicode__(self):
         return "%s %s: (user %s, ensemble %s)" % (self.__class__.__name__, self.id,  self.user_id, self.ensemble_id)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "ensemble", "deleted"], name="membership_user_ens_del")]
+
 
 class Source(models.Model):
     TYPE_PDF = 1
@@ -199,6 +211,9 @@ class Ownership(models.Model):
     def __unicode__(self):
         return "%s %s: source %s in ensemble %s" % (self.__class__.__name__, self.id,  self.source_id, self.ensemble_id)
 
+    class Meta:
+        indexes = [models.Index(fields=["source", "deleted"], name="ownership_source_del")]
+
 
 # old: nb2_location
 class Location(models.Model):
@@ -218,6 +233,9 @@ class Location(models.Model):
     def __unicode__(self):
         return "%s %s: on source %s - page %s " % (self.__class__.__name__, self.id,  self.source_id, self.page)
 
+    class Meta:
+        indexes = [models.Index(fields=["source", "page"], name="location_source_page")]
+
 
 class HTML5Location(models.Model):
     location = OneToOneField(Location, on_delete=models.CASCADE)
@@ -242,6 +260,8 @@ class Comment(models.Model):
     # old: vis_status integer DEFAULT 0
     deleted = BooleanField(default=False)
     moderated = BooleanField(default=False)
+    # last time this row was saved (cf signals.py)
+    mtime = DateTimeField(default=datetime.now, db_index=True)
 
     def __unicode__(self):
         return "%s %s: %s " % (self.__class__.__name__, self.id,  self.body[:50])
@@ -253,6 +273,13 @@ class Comment(models.Model):
         else:
             return str(calendar.timegm(self.ctime.astimezone(pytz.utc).timetuple()))
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["location", "deleted", "parent"], name="comment_loc_del_parent"),
+            # root comments, cf canMarkThread
+            models.Index(fields=["location"], condition=models.Q(parent=None), name="comment_root"),
+        ]
+
 # Represents Users tagged in a comment
 
 
@@ -286,6 +313,7 @@ class ThreadMark(models.Model):
     # this is optional
     comment = ForeignKey(Comment, null=True, on_delete=models.SET_NULL)
     user = ForeignKey(User, on_delete=models.CASCADE)
+    mtime = DateTimeField(default=datetime.now, db_index=True)
 
     def resolved(self):
         return self.replyrating_set.filter(status__gt=ReplyRating.TYPE_UNRESOLVED).exists()
@@ -302,6 +330,7 @@ class ReplyRating(models.Model):
     comment = ForeignKey(Comment, on_delete=models.CASCADE)
     ctime = DateTimeField(default=datetime.now, db_index=True)
     status = IntegerField(choices=TYPES)
+    mtime = DateTimeField(default=datetime.now, db_index=True)
 
 
 class ThreadMarkHistory(models.Model):
@@ -324,6 +353,10 @@ class Processqueue(models.Model):
     started = DateTimeField(null=True)
     # old: completed timestamp without time zone
     completed = DateTimeField(null=True)
+    # new: set when the job was given up on (cf processing.py)
+    failed = DateTimeField(null=True)
+    # new: number of times the job was claimed
+    attempts = IntegerField(default=0)
 
 
 # TODO: Continue migratedbscript from here.
@@ -342,6 +375,9 @@ class CommentSeen(models.Model):
     user = ForeignKey(User, on_delete=models.CASCADE)
     ctime = DateTimeField(default=datetime.now)
 
+    class Meta:
+        indexes = [models.Index(fields=["user", "comment"], name="commentseen_user_comment")]
+
 
 class PageSeen(models.Model):
     source = ForeignKey(Source, on_delete=models.CASCADE)
@@ -352,6 +388,27 @@ class PageSeen(models.Model):
     ctime = DateTimeField(default=datetime.now)
 
 
+# Maintained by unread.py, so that unread counts don't need to scan CommentSeen
+class PageCommentCount(models.Model):
+    source = ForeignKey(Source, on_delete=models.CASCADE)
+    page = IntegerField()
+    total = IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("source", "page")]
+
+
+class PageSeenCount(models.Model):
+    user = ForeignKey(User, on_delete=models.CASCADE)
+    source = ForeignKey(Source, on_delete=models.CASCADE)
+    page = IntegerField()
+    # number of distinct comments of that page the user has seen
+    seen = IntegerField(default=0)
+
+    class Meta:
+        unique_together = [("user", "source", "page")]
+
+
 class AnalyticsVisit(models.Model):
     source = ForeignKey(Source, on_delete=models.CASCADE)
     user = ForeignKey(User, null=True, on_delete=models.SET_NULL)
@@ -434,6 +491,13 @@ class GuestHistory(models.Model):
     t_start = DateTimeField(null=True, default=datetime.now)
     t_end = DateTimeField(null=True)
 
+    class Meta:
+        indexes = [
+            # the guests of the pool that weren't handed out yet, cf guests.py
+            models.Index(fields=["id"], condition=models.Q(t_start=None, t_end=None),
+                         name="guesthistory_unclaimed"),
+        ]
+
 
 class GuestLoginHistory(models.Model):
     """
@@ -0,0 +1,170 @@
+"""
+perms.py - In-memory permission data used by the checks in auth.py
+
+A user's memberships, the source -> ensemble ownership map and the
+settings of each ensemble are loaded once and kept for PERMISSION_CACHE_TTL
+seconds, so that a page which calls canReadFile, canAnnotate, isMember...
+many times only hits the database once.
+Entries are invalidated from signals.py when Membership, Ownership or
+Ensemble rows change.
+"""
+import json
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.conf import settings
+
+from . import models as M
+
+# admin: at least one non-deleted admin membership in that ensemble
+# guest: all the non-deleted memberships in that ensemble are guest ones
+Member = namedtuple("Member", ["admin", "guest"])
+
+# ensemble that owns a source, and whether that ownership was deleted
+Owner = namedtuple("Owner", ["ensemble_id", "deleted"])
+
+
+class EnsembleSettings:
+    """Read-only copy of the flags of an Ensemble, with its metadata already parsed"""
+    FIELDS = ("id", "allow_staffonly", "allow_anonymous", "allow_tag_private", "allow_guest",
+              "use_invitekey", "allow_download", "allow_ondemand", "default_pause", "section_assignment")
+    __slots__ = FIELDS + ("metadata",)
+
+    def __init__(self, *values, metadata=None):
+        for name, value in zip(self.FIELDS, values):
+            object.__setattr__(self, name, value)
+        try:
+            metadata = json.loads(metadata) if metadata else {}
+            if not isinstance(metadata, dict):
+                metadata = {}
+        except ValueError:
+            metadata = {}
+        object.__setattr__(self, "metadata", MappingProxyType(metadata))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("EnsembleSettings is read-only")
+
+
+class TTLCache:
+    """Thread-safe dict whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._data) >= self.maxsize and key not in self._data:
+                self._evict(now)
+            self._data[key] = (now + self.ttl, value)
+
+    def _evict(self, now):
+        expired = [k for k, v in self._data.items() if v[0] < now]
+        for k in expired:
+            del self._data[k]
+        if len(self._data) >= self.maxsize:
+            # still full: drop the entry closest to expiry
+            del self._data[min(self._data, key=lambda k: self._data[k][0])]
+
+    def items(self):
+        """(key, value) of the entries that haven't expired"""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v[1]) for k, v in self._data.items() if v[0] >= now]
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class PermissionResolver:
+    def __init__(self, ttl=None, maxsize=None):
+        if ttl is None:
+            ttl = getattr(settings, "PERMISSION_CACHE_TTL", 30)
+        if maxsize is None:
+            maxsize = getattr(settings, "PERMISSION_CACHE_SIZE", 10000)
+        self._members = TTLCache(ttl, maxsize)
+        self._owners = TTLCache(ttl, maxsize)
+        self._ensembles = TTLCache(ttl, maxsize)
+
+    def memberships(self, uid):
+        """returns {ensemble_id: Member} for the non-deleted memberships of uid"""
+        uid = int(uid)
+        members = self._members.get(uid)
+        if members is None:
+            members = {}
+            rows = M.Membership.objects.filter(user_id=uid, deleted=False).values_list(
+                "ensemble_id", "admin", "guest")
+            for eid, admin, guest in rows:
+                m = members.get(eid)
+                if m is not None:
+                    admin = admin or m.admin
+                    guest = guest and m.guest
+                members[eid] = Member(admin, guest)
+            self._members.set(uid, members)
+        return members
+
+    def membership(self, uid, eid):
+        return self.memberships(uid).get(int(eid))
+
+    def owners(self, id_source):
+        """returns the list of Owner for that source, including deleted ownerships"""
+        id_source = int(id_source)
+        owners = self._owners.get(id_source)
+        if owners is None:
+            owners = [Owner(*row) for row in M.Ownership.objects.filter(
+                source_id=id_source).values_list("ensemble_id", "deleted")]
+            self._owners.set(id_source, owners)
+        return owners
+
+    def ensemble(self, eid):
+        """EnsembleSettings of eid"""
+        eid = int(eid)
+        e = self._ensembles.get(eid)
+        if e is None:
+            values = M.Ensemble.objects.values_list(*EnsembleSettings.FIELDS, "metadata").get(pk=eid)
+            e = EnsembleSettings(*values[:-1], metadata=values[-1])
+            self._ensembles.set(eid, e)
+        return e
+
+    def sourceMemberships(self, uid, id_source, include_deleted=False):
+        """Member records of uid for the ensembles that own id_source"""
+        members = self.memberships(uid)
+        return [members[o.ensemble_id] for o in self.owners(id_source)
+                if o.ensemble_id in members and (include_deleted or not o.deleted)]
+
+    def invalidateUser(self, uid):
+        self._members.pop(int(uid))
+
+    def invalidateSource(self, id_source):
+        self._owners.pop(int(id_source))
+
+    def invalidateEnsemble(self, eid):
+        self._ensembles.pop(int(eid))
+
+    def clear(self):
+        self._members.clear()
+        self._owners.clear()
+        self._ensembles.clear()
+
+
+resolver = PermissionResolver()
@@ -0,0 +1,195 @@
+"""
+processing.py - Processes the PDFs waiting in Processqueue
+
+Each Processqueue row with started NULL is a job. Workers claim jobs with a
+single conditional UPDATE (with FOR UPDATE SKIP LOCKED on PostgreSQL), so
+that several workers or processes never run the same one. A claim is a
+lease: a job that is still not completed PDF_JOB_LEASE seconds after it
+was started (its worker died) can be claimed again. A job that fails is
+released for another attempt, and after PDF_MAX_ATTEMPTS claims it is
+marked failed and left alone. The PDF itself
+is read in a process pool (PDF_WORKERS processes) and the main process
+saves the page count, size, trimbox origin and rotation of the first page
+into the Source.
+
+PDFs are read from PDF_REPOSITORY/<source id>. Reading them requires
+PyMuPDF (pip install pymupdf).
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Avg, DurationField, ExpressionWrapper, F, Q
+
+from . import models as M
+from .db import Db
+
+CLAIM_QUERY_POSTGRES = """
+UPDATE base_processqueue SET started = ?, attempts = attempts + 1
+WHERE id = (SELECT id FROM base_processqueue
+            WHERE completed IS NULL AND failed IS NULL AND attempts < ? AND (started IS NULL OR started < ?)
+            ORDER BY submitted, id LIMIT 1 FOR UPDATE SKIP LOCKED)
+RETURNING id, source_id"""
+
+
+def _lease():
+    return getattr(settings, "PDF_JOB_LEASE", 600)
+
+
+def _maxAttempts():
+    return getattr(settings, "PDF_MAX_ATTEMPTS", 3)
+
+
+def claimable(expired):
+    """jobs that can be claimed, expired being the start time before which a lease is over"""
+    return M.Processqueue.objects.filter(Q(started=None) | Q(started__lt=expired), completed=None, failed=None,
+                                         attempts__lt=_maxAttempts())
+
+
+def pdfPath(id_source):
+    return os.path.join(str(getattr(settings, "PDF_REPOSITORY", "pdf")), str(id_source))
+
+
+def analyze(path):
+    """metadata of the PDF at path, as Source fields. Runs in a worker process."""
+    import fitz  # PyMuPDF
+
+    with fitz.open(path) as doc:
+        page = doc[0]
+        # PDF coordinates: origin at the lower-left corner of the media box
+        box = page.trimbox
+        media = page.mediabox
+        return {
+            "numpages": doc.page_count,
+            "w": int(round(box.width)),
+            "h": int(round(box.height)),
+            "x0": int(round(box.x0)),
+            "y0": int(round(media.height - box.y1)),
+            "rotation": page.rotation,
+        }
+
+
+def claim():
+    """marks the oldest claimable job as started and returns (job id, source id), or None"""
+    db = Db()
+    now = datetime.now()
+    expired = now - timedelta(seconds=_lease())
+    if db.postgres:
+        return db.getRow(CLAIM_QUERY_POSTGRES, (now, _maxAttempts(), expired), prepare=True)
+    for _ in range(5):
+        job = claimable(expired).order_by("submitted", "id").values_list("id", "source_id", "started").first()
+        if job is None:
+            return None
+        # only one worker gets to change started from the value it read
+        if M.Processqueue.objects.filter(pk=job[0], started=job[2], completed=None).update(
+                started=now, attempts=F("attempts") + 1):
+            return job[:2]
+    return None
+
+
+def complete(id_job, id_source, info):
+    M.Source.objects.filter(pk=id_source).update(**info)
+    M.Processqueue.objects.filter(pk=id_job).update(completed=datetime.now())
+
+
+def fail(id_job):
+    """releases a job that raised, or marks it failed if it had all its attempts"""
+    if not M.Processqueue.objects.filter(pk=id_job, attempts__gte=_maxAttempts()).update(failed=datetime.now()):
+        M.Processqueue.objects.filter(pk=id_job).update(started=None)
+
+
+def reap():
+    """marks failed the jobs whose last lease expired (their worker died) with no attempt left"""
+    expired = datetime.now() - timedelta(seconds=_lease())
+    return M.Processqueue.objects.filter(started__lt=expired, completed=None, failed=None,
+                                         attempts__gte=_maxAttempts()).update(failed=datetime.now())
+
+
+def stats(window=3600):
+    """
+    queue depth, jobs running, jobs failed over the last window sec, mean
+    wait and mean processing time (sec) and jobs completed per minute
+    """
+    now = datetime.now()
+    since = now - timedelta(seconds=window)
+    expired = now - timedelta(seconds=_lease())
+    done = M.Processqueue.objects.filter(completed__gte=since)
+    avg = done.aggregate(
+        wait=Avg(ExpressionWrapper(F("started") - F("submitted"), output_field=DurationField())),
+        run=Avg(ExpressionWrapper(F("completed") - F("started"), output_field=DurationField())))
+    return {
+        "depth": claimable(expired).count(),
+        "running": M.Processqueue.objects.filter(started__gte=expired, completed=None, failed=None).count(),
+        "failed": M.Processqueue.objects.filter(failed__gte=since).count(),
+        "wait": avg["wait"].total_seconds() if avg["wait"] is not None else None,
+        "run": avg["run"].total_seconds() if avg["run"] is not None else None,
+        "per_minute": done.count() * 60.0 / window,
+    }
+
+
+def _finish(running, future):
+    """saves the result of a done future, or fails its job; returns True if its worker process died"""
+    id_job, id_source = running.pop(future)
+    try:
+        complete(id_job, id_source, future.result())
+    except Exception as e:
+        logging.exception("[processing] job %s (source %s) failed", id_job, id_source)
+        fail(id_job)
+        return isinstance(e, BrokenProcessPool)
+    return False
+
+
+def _restart(pool, running, workers):
+    # a worker process died (killed, out of memory, crash in PyMuPDF...):
+    # the pool can't run anything anymore, and the jobs still in it are lost
+    pool.shutdown(wait=True)
+    for future in list(running):
+        _finish(running, future)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def run(workers=None, once=False, poll=None):
+    """
+    processes jobs until interrupted, or until the queue is empty if once.
+    Jobs that fail are logged, and released or marked failed (see fail).
+    If a worker process dies, the jobs of the pool fail and the pool is
+    started again.
+    """
+    if workers is None:
+        workers = getattr(settings, "PDF_WORKERS", os.cpu_count() or 1)
+    if poll is None:
+        poll = getattr(settings, "PDF_POLL_INTERVAL", 5)
+    running = {}  # future -> (job id, source id)
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            close_old_connections()
+            reap()
+            while len(running) < workers:
+                job = claim()
+                if job is None:
+                    break
+                try:
+                    running[pool.submit(analyze, pdfPath(job[1]))] = job
+                except BrokenProcessPool:
+                    logging.exception("[processing] job %s (source %s) not started", *job)
+                    fail(job[0])
+                    pool = _restart(pool, running, workers)
+            if not running:
+                if once:
+                    return
+                time.sleep(poll)
+                continue
+            done, _ = wait(running, timeout=poll, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                broken = _finish(running, future) or broken
+            if broken:
+                pool = _restart(pool, running, workers)
+    finally:
+        pool.shutdown()
@@ -0,0 +1,191 @@
+"""
+render.py - Cached rendering of the pages of PDF sources
+
+Page images are rendered by a pool of RENDER_WORKERS processes and stored
+in RENDER_CACHE_DIR under a name derived from (source id, Source.version,
+page, resolution), so that a new version of a source never hits a stale
+image. Pages come out upright: PyMuPDF applies their /Rotate (which is
+what Source.rotation records) when rendering. The cache is kept under
+RENDER_CACHE_SIZE bytes by removing the least recently used images (hits
+refresh the file's mtime).
+
+renderer.page() renders a page on first request, and queues the
+RENDER_PREWARM pages around it in the background. renderer.document()
+renders every page of a source, spread over the pool. If a rendering
+process dies, the pool is started again.
+
+Rendering requires PyMuPDF (pip install pymupdf).
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+
+from . import models as M
+from .processing import pdfPath
+
+
+def renderPage(path, page, resolution, dest):
+    """renders page (1-based) of the PDF at path as a PNG at dest. Runs in a worker process."""
+    import fitz  # PyMuPDF
+
+    with fitz.open(path) as doc:
+        matrix = fitz.Matrix(resolution / 72.0, resolution / 72.0)
+        pix = doc[page - 1].get_pixmap(matrix=matrix)
+        tmp = "%s.%s.tmp" % (dest, os.getpid())
+        pix.save(tmp, output="png")
+    os.replace(tmp, dest)
+    return os.path.getsize(dest)
+
+
+class PageCache:
+    def __init__(self, directory=None, max_size=None):
+        self.directory = str(directory if directory is not None else getattr(
+            settings, "RENDER_CACHE_DIR", "render_cache"))
+        self.max_size = max_size if max_size is not None else getattr(settings, "RENDER_CACHE_SIZE", 2 << 30)
+        self._size = None  # total size of the cache, computed on first use
+        self._lock = threading.Lock()
+
+    def path(self, id_source, version, page, resolution):
+        key = hashlib.sha1(("%s/%s/%s/%s" % (id_source, version, page, resolution)).encode("ascii")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+    def get(self, path):
+        """path if it is in the cache, None otherwise"""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _files(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".png"):
+                    p = os.path.join(root, name)
+                    try:
+                        st = os.stat(p)
+                    except FileNotFoundError:
+                        continue
+                    yield st.st_mtime, st.st_size, p
+
+    def added(self, size):
+        """to call when an image of size bytes was written"""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(f[1] for f in self._files())
+            else:
+                self._size += size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # down to 90% of the limit, so that we don't walk the cache on every write
+        target = self.max_size * 0.9
+        for _, size, p in sorted(self._files()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+
+class Renderer:
+    def __init__(self, cache=None, workers=None):
+        self.cache = cache if cache is not None else PageCache()
+        self.workers = workers if workers is not None else getattr(settings, "RENDER_WORKERS", 4)
+        self._pool = None
+        self._pending = {}  # cache path -> future
+        # reentrant: a future that is already done runs _done right away
+        self._lock = threading.RLock()
+
+    def _submit(self, id_source, version, page, resolution):
+        dest = self.cache.path(id_source, version, page, resolution)
+        if self.cache.get(dest) is not None:
+            return dest, None
+        with self._lock:
+            future = self._pending.get(dest)
+            if future is None:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                args = (renderPage, pdfPath(id_source), page, resolution, dest)
+                try:
+                    future = self._executor().submit(*args)
+                except BrokenProcessPool:
+                    # a rendering process died since the last submit
+                    self._broken(self._pool)
+                    future = self._executor().submit(*args)
+                self._pending[dest] = future
+                pool = self._pool
+                future.add_done_callback(lambda f: self._done(dest, f, pool))
+        return dest, future
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def _broken(self, pool):
+        # the pool can't run anything anymore: the next submit starts another
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _done(self, dest, future, pool):
+        with self._lock:
+            self._pending.pop(dest, None)
+        try:
+            self.cache.added(future.result())
+        except BrokenProcessPool:
+            logging.exception("[render] rendering process died while rendering %s", dest)
+            self._broken(pool)
+        except Exception:
+            logging.exception("[render] could not render %s", dest)
+
+    def page(self, id_source, page, resolution):
+        """path of the image of that page, rendering it if needed; None if the source has no such page"""
+        source = M.Source.objects.filter(pk=id_source).values_list("version", "numpages").first()
+        if source is None or source[1] is None or not 1 <= page <= source[1]:
+            return None
+        version, numpages = source
+        dest, future = self._submit(id_source, version, page, resolution)
+        prewarm = getattr(settings, "RENDER_PREWARM", 2)
+        for p in range(max(page - prewarm, 1), min(page + prewarm, numpages) + 1):
+            if p != page:
+                self._submit(id_source, version, p, resolution)
+        if future is not None:
+            try:
+                future.result()
+            except BrokenProcessPool:
+                # not necessarily because of this page: try once more
+                with self._lock:
+                    if self._pending.get(dest) is future:
+                        del self._pending[dest]
+                dest, future = self._submit(id_source, version, page, resolution)
+                if future is not None:
+                    future.result()
+        return dest
+
+    def document(self, id_source, resolutions):
+        """renders every page of that source at each resolution; returns {(page, resolution): path}"""
+        version, numpages = M.Source.objects.values_list("version", "numpages").get(pk=id_source)
+        out = {}
+        futures = []
+        for resolution in resolutions:
+            for p in range(1, numpages + 1):
+                dest, future = self._submit(id_source, version, p, resolution)
+                out[(p, resolution)] = dest
+                if future is not None:
+                    futures.append(future)
+        for future in futures:
+            future.result()
+        return out
+
+
+renderer = Renderer()
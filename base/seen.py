@@ -0,0 +1,143 @@
+"""
+seen.py - Write-behind buffers for the PageSeen and CommentSeen telemetry
+
+Every page turn and comment scroll in the reader records a "seen" row.
+Rather than inserting them one at a time from the request, they are queued
+in memory and a background thread writes them in batches with
+Db.insertObjects, whenever SEEN_BATCH_SIZE rows are pending or every
+SEEN_FLUSH_INTERVAL seconds. At most SEEN_BUFFER_SIZE rows are kept in
+memory: when the buffer is full, record* waits up to SEEN_PUT_TIMEOUT
+seconds for the writer to catch up and then drops the event.
+Pending rows are written when the process exits.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import models as M
+from . import unread
+from .db import Db
+
+
+class WriteBehindBuffer:
+    def __init__(self, model, max_size=None, batch_size=None, flush_interval=None, put_timeout=None,
+                 after_write=None):
+        self.model = model
+        # called with each batch once it is written
+        self.after_write = after_write
+        self.max_size = max_size if max_size is not None else getattr(settings, "SEEN_BUFFER_SIZE", 50000)
+        self.batch_size = batch_size if batch_size is not None else getattr(settings, "SEEN_BATCH_SIZE", 500)
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, "SEEN_FLUSH_INTERVAL", 2)
+        self.put_timeout = put_timeout if put_timeout is not None else getattr(settings, "SEEN_PUT_TIMEOUT", 0.05)
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+    def put(self, obj):
+        """queues obj (an unsaved model instance). Returns False if it was dropped."""
+        with self._cond:
+            if self._thread is None and not self._stopping:
+                self._start()
+            if len(self._pending) >= self.max_size:
+                self._cond.notify_all()
+                deadline = time.monotonic() + self.put_timeout
+                while len(self._pending) >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._stopping:
+                        self.dropped += 1
+                        return False
+                    self._cond.wait(remaining)
+            self._pending.append(obj)
+            self.queued += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def flush(self):
+        """writes everything that is pending, in batches. Returns the number of rows written."""
+        n = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                    # wake up the callers waiting for room in put()
+                    self._cond.notify_all()
+                if not batch:
+                    return n
+                try:
+                    Db().insertObjects(self.model, batch)
+                except Exception:
+                    logging.exception("[seen] could not write %s %s rows", len(batch), self.model.__name__)
+                    with self._cond:
+                        self.failed += len(batch)
+                    return n
+                with self._cond:
+                    self.flushed += len(batch)
+                n += len(batch)
+                if self.after_write is not None:
+                    try:
+                        self.after_write(batch)
+                    except Exception:
+                        logging.exception("[seen] after_write failed for %s %s rows", len(batch),
+                                          self.model.__name__)
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._pending), "queued": self.queued, "flushed": self.flushed,
+                    "dropped": self.dropped, "failed": self.failed}
+
+    def stop(self):
+        """stops the writer thread and writes what is left"""
+        with self._cond:
+            self._stopping = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="seen-%s" % self.model.__name__, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopping:
+                    return
+            self.flush()
+
+
+pages = WriteBehindBuffer(M.PageSeen)
+comments = WriteBehindBuffer(M.CommentSeen, after_write=unread.commentsSeen)
+
+
+def recordPageSeen(id_source, page, uid, id_session=None):
+    return pages.put(M.PageSeen(source_id=id_source, page=page, user_id=uid, session_id=id_session))
+
+
+def recordCommentSeen(id_comment, uid, id_session=None):
+    return comments.put(M.CommentSeen(comment_id=id_comment, user_id=uid, session_id=id_session))
+
+
+@atexit.register
+def _flushAll():
+    pages.stop()
+    comments.stop()
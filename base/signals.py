@@ -0,0 +1,108 @@
+"""
+signals.py - Keeps the in-memory caches consistent with the database, and
+the mtime columns (used by the sync API in views.py) and unread counts up
+to date
+"""
+from datetime import datetime
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import models as M
+from . import unread
+from .anchors import anchors
+from .folders import tree
+from .perms import resolver
+from .spatial import indexes
+from .timeline import timelines
+
+
+def invalidate(f, *args):
+    # right away, so that the rest of the transaction sees the change, and
+    # again on commit: until then, other threads still read (and may have
+    # cached) the old rows
+    f(*args)
+    transaction.on_commit(lambda: f(*args))
+
+
+@receiver([post_save, post_delete], sender=M.Membership)
+def membership_changed(sender, instance, **kwargs):
+    invalidate(resolver.invalidateUser, instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=M.Ownership)
+def ownership_changed(sender, instance, **kwargs):
+    invalidate(resolver.invalidateSource, instance.source_id)
+
+
+@receiver([post_save, post_delete], sender=M.Ensemble)
+def ensemble_changed(sender, instance, **kwargs):
+    invalidate(resolver.invalidateEnsemble, instance.id)
+    # default_pause: rare enough that we don't track which sources it affects
+    timelines.clear()
+
+
+@receiver(post_save, sender=M.Folder)
+def folder_saved(sender, instance, **kwargs):
+    tree.folderSaved(instance.id, instance.ensemble_id, instance.parent_id)
+
+
+@receiver(post_delete, sender=M.Folder)
+def folder_deleted(sender, instance, **kwargs):
+    tree.folderDeleted(instance.id)
+
+
+@receiver(pre_save, sender=M.Comment)
+@receiver(pre_save, sender=M.ThreadMark)
+@receiver(pre_save, sender=M.ReplyRating)
+def touch_mtime(sender, instance, **kwargs):
+    # QuerySet.update() doesn't send pre_save, and save(update_fields=...)
+    # only writes mtime if it is listed: set it explicitly in those cases
+    instance.mtime = datetime.now()
+
+
+@receiver(pre_save, sender=M.Comment)
+def comment_saving(sender, instance, **kwargs):
+    unread.commentSaving(instance)
+
+
+@receiver(post_save, sender=M.Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    source_id, page = M.Location.objects.values_list("source_id", "page").get(pk=instance.location_id)
+    unread.commentSaved(instance, created, source_id, page)
+    if instance.parent_id is None:
+        # the root comment decides whether a video pauses there by default
+        timelines.invalidate(source_id)
+
+
+@receiver(pre_delete, sender=M.Comment)
+def comment_deleting(sender, instance, **kwargs):
+    unread.commentDeleting(instance)
+
+
+@receiver(post_delete, sender=M.Comment)
+def comment_deleted(sender, instance, **kwargs):
+    unread.commentDeleted(instance)
+
+
+@receiver(post_save, sender=M.Location)
+def location_saved(sender, instance, **kwargs):
+    indexes.locationSaved(instance)
+    timelines.invalidate(instance.source_id)
+
+
+@receiver(post_delete, sender=M.Location)
+def location_deleted(sender, instance, **kwargs):
+    indexes.locationDeleted(instance)
+    timelines.invalidate(instance.source_id)
+    anchors.invalidate(instance.source_id)
+
+
+@receiver([post_save, post_delete], sender=M.HTML5Location)
+def html5location_changed(sender, instance, **kwargs):
+    id_source = M.Location.objects.filter(pk=instance.location_id).values_list("source_id", flat=True).first()
+    if id_source is None:
+        anchors.clear()
+    else:
+        anchors.invalidate(id_source)
@@ -0,0 +1,147 @@
+"""
+spatial.py - In-memory spatial index of the Location rectangles of a page
+
+indexes.page(id_source, version, page) returns a PageIndex built from the
+Location rows of that page (one query), which answers "which locations
+intersect this rectangle" and "which location is closest to this point"
+without scanning every location of the page. Rectangles are bucketed in a
+uniform grid of SPATIAL_CELL_SIZE units. Indexes are kept for
+SPATIAL_CACHE_TTL seconds, and new or moved locations are added to the
+cached index from signals.py.
+"""
+import math
+import threading
+
+from django.conf import settings
+
+from . import models as M
+from .perms import TTLCache
+
+
+class PageIndex:
+    def __init__(self, cell=None):
+        self.cell = cell if cell is not None else getattr(settings, "SPATIAL_CELL_SIZE", 64)
+        self._rects = {}    # id -> (x0, y0, x1, y1)
+        self._cells = {}    # (cx, cy) -> set of ids
+        self._lock = threading.Lock()
+
+    def _span(self, x0, y0, x1, y1):
+        c = self.cell
+        for cx in range(math.floor(x0 / c), math.floor(x1 / c) + 1):
+            for cy in range(math.floor(y0 / c), math.floor(y1 / c) + 1):
+                yield cx, cy
+
+    def add(self, id, x, y, w, h):
+        rect = (x, y, x + w, y + h)
+        with self._lock:
+            self._remove(id)
+            self._rects[id] = rect
+            for key in self._span(*rect):
+                self._cells.setdefault(key, set()).add(id)
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        rect = self._rects.pop(id, None)
+        if rect is not None:
+            for key in self._span(*rect):
+                ids = self._cells[key]
+                ids.discard(id)
+                if not ids:
+                    del self._cells[key]
+
+    def intersecting(self, x, y, w, h):
+        """ids of the locations whose rectangle intersects (x, y, w, h), edges included"""
+        x1, y1 = x + w, y + h
+        out = set()
+        with self._lock:
+            seen = set()
+            for key in self._span(x, y, x1, y1):
+                for id in self._cells.get(key, ()):
+                    if id in seen:
+                        continue
+                    seen.add(id)
+                    r = self._rects[id]
+                    if r[0] <= x1 and x <= r[2] and r[1] <= y1 and y <= r[3]:
+                        out.add(id)
+        return out
+
+    def nearest(self, x, y):
+        """(id, distance) of the location closest to (x, y), 0 if inside it; None if the page is empty"""
+        with self._lock:
+            if not self._rects:
+                return None
+            c = self.cell
+            cx, cy = math.floor(x / c), math.floor(y / c)
+            best = None
+            # rings of cells around (cx, cy); once a ring is farther than the
+            # best candidate, nothing beyond it can be closer
+            radius = 0
+            max_radius = self._maxRadius(cx, cy)
+            while radius <= max_radius:
+                if best is not None and (radius - 1) * c > best[1]:
+                    break
+                for key in self._ring(cx, cy, radius):
+                    for id in self._cells.get(key, ()):
+                        r = self._rects[id]
+                        d = math.hypot(max(r[0] - x, 0, x - r[2]), max(r[1] - y, 0, y - r[3]))
+                        if best is None or d < best[1] or (d == best[1] and id < best[0]):
+                            best = (id, d)
+                radius += 1
+            return best
+
+    def _maxRadius(self, cx, cy):
+        return max(max(abs(kx - cx), abs(ky - cy)) for kx, ky in self._cells)
+
+    def _ring(self, cx, cy, radius):
+        if radius == 0:
+            yield cx, cy
+            return
+        for i in range(-radius, radius + 1):
+            yield cx + i, cy - radius
+            yield cx + i, cy + radius
+        for i in range(-radius + 1, radius):
+            yield cx - radius, cy + i
+            yield cx + radius, cy + i
+
+    def __len__(self):
+        return len(self._rects)
+
+
+class SpatialIndexes:
+    def __init__(self):
+        self._pages = TTLCache(getattr(settings, "SPATIAL_CACHE_TTL", 300),
+                               getattr(settings, "SPATIAL_CACHE_SIZE", 1000))
+
+    def page(self, id_source, version, page):
+        key = (int(id_source), int(version), int(page))
+        index = self._pages.get(key)
+        if index is None:
+            index = PageIndex()
+            for id, x, y, w, h in M.Location.objects.filter(
+                    source_id=key[0], version=key[1], page=key[2]).values_list("id", "x", "y", "w", "h"):
+                index.add(id, x, y, w, h)
+            self._pages.set(key, index)
+        return index
+
+    def locationSaved(self, location):
+        # the location may have moved: drop it from every cached page of that source
+        for key, index in self._pages.items():
+            if key[0] == location.source_id:
+                index.remove(location.id)
+        index = self._pages.get((location.source_id, location.version, location.page))
+        if index is not None:
+            index.add(location.id, location.x, location.y, location.w, location.h)
+
+    def locationDeleted(self, location):
+        index = self._pages.get((location.source_id, location.version, location.page))
+        if index is not None:
+            index.remove(location.id)
+
+    def clear(self):
+        self._pages.clear()
+
+
+indexes = SpatialIndexes()
@@ -1,3 +1,990 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import activity, auth, delivery, export, folders, guests, processing, render, seen, threads, unread, views
+from . import models as M
+from .anchors import AnchorIndex
+from .db import Db, getPool, toPrepared, toPyformat
+from .perms import resolver
+from .spatial import PageIndex, indexes
+from .timeline import timelines
+
+
+class DbTests(TestCase):
+    def test_placeholders(self):
+        self.assertEqual(Db().getVal("SELECT ? + ?", (1, 2)), 3)
+        self.assertEqual(toPyformat("a = ? AND b = ?"), "a = %s AND b = %s")
+        name, qry, nargs = toPrepared("SELECT a FROM t WHERE a = ? AND b = ?")
+        self.assertEqual(qry, "PREPARE %s AS SELECT a FROM t WHERE a = $1 AND b = $2" % name)
+        self.assertEqual(nargs, 2)
+        self.assertEqual(toPrepared("SELECT a FROM t WHERE a = ? AND b = ?")[0], name)
+        self.assertNotEqual(toPrepared("SELECT a FROM t WHERE a = ?")[0], name)
+
+    def test_prepared(self):
+        # ignored on SQLite: same results as the plain query
+        self.assertEqual(Db().getRows("SELECT ? + ?", (1, 2), prepare=True), [(3,)])
+        with self.assertRaises(ValueError):
+            Db().execute("SELECT 1", (), Db().getNewConnection(), chunked=True, prepare=True)
+
+    def test_benchmark(self):
+        out = io.StringIO()
+        call_command("benchmark", number=2, stdout=out)
+        self.assertIn("toPrepared, uncached", out.getvalue())
+        self.assertIn("getRows, prepared", out.getvalue())
+        self.assertIn("canReadFile loop", out.getvalue())
+
+    def test_sees_uncommitted_rows(self):
+        # TestCase runs in a transaction: Db must use Django's connection
+        u = M.User.objects.create(email="a@example.com")
+        self.assertEqual(Db().getVal("SELECT email FROM base_user WHERE id = ?", (u.id,)), "a@example.com")
+        Db().doTransaction("UPDATE base_user SET firstname = ? WHERE id = ?", ("Ada", u.id))
+        self.assertEqual(M.User.objects.get(pk=u.id).firstname, "Ada")
+        db = Db()
+        conn = db.getNewConnection()
+        self.assertEqual(db.execute("SELECT email FROM base_user WHERE id = ?", (u.id,), conn).fetchone(),
+                         ("a@example.com",))
+        db.releaseConnection(conn)
+
+
+class DbPoolTests(TransactionTestCase):
+    def test_pooled_connection(self):
+        u = M.User.objects.create(email="a@example.com")
+        pool = getPool("default")
+        idle = len(pool._idle)
+        self.assertEqual(list(Db().iterRows("SELECT id FROM base_user WHERE email = ?", ("a@example.com",))),
+                         [(u.id,)])
+        Db().doTransaction("UPDATE base_user SET firstname = ? WHERE id = ?", ("Ada", u.id))
+        self.assertEqual(M.User.objects.get(pk=u.id).firstname, "Ada")
+        # the connection went back to the pool
+        self.assertEqual(len(pool._idle), max(idle, 1))
+
+    def test_execute_without_connection(self):
+        pool = getPool("default")
+        size = pool.size
+        # more than the pool holds: each call gives its connection back
+        for i in range(pool.max_size * 2):
+            self.assertEqual(Db().execute("SELECT ?", (i,)).fetchone(), (i,))
+        self.assertLessEqual(pool.size, max(size, 1))
+        with Db() as db:
+            db.execute("SELECT 1", (), db.connectMaybe()).close()
+        self.assertIsNone(db.conn)
+        with self.assertRaises(ValueError):
+            Db().execute("SELECT 1", (), chunked=True)
+
+
+# the settings the project ships with: SQLite, and DEBUG on (the test runner
+# turns it off), which logs every query through the debug cursor
+@override_settings(DEBUG=True)
+class FolderTests(TestCase):
+    def setUp(self):
+        resolver.clear()
+        self.user = M.User.objects.create(email="admin@example.com", valid=True)
+        self.ensemble = M.Ensemble.objects.create(name="class")
+        M.Membership.objects.create(user=self.user, ensemble=self.ensemble, admin=True)
+        self.root = M.Folder.objects.create(ensemble=self.ensemble, name="root")
+        self.child = M.Folder.objects.create(ensemble=self.ensemble, parent=self.root, name="child")
+        self.leaf = M.Folder.objects.create(ensemble=self.ensemble, parent=self.child, name="leaf")
+        self.other = M.Folder.objects.create(ensemble=self.ensemble, name="other")
+
+    def test_queries(self):
+        self.assertEqual(folders.ancestors(self.leaf.id), [self.leaf.id, self.child.id, self.root.id])
+        self.assertEqual(sorted(folders.descendants(self.root.id)), sorted([self.root.id, self.child.id,
+                                                                            self.leaf.id]))
+        self.assertTrue(folders.isDirOrParent(self.root.id, self.leaf.id))
+        self.assertTrue(folders.isDirOrParent(self.leaf.id, self.leaf.id))
+        self.assertFalse(folders.isDirOrParent(self.leaf.id, self.root.id))
+        self.assertFalse(folders.isDirOrParent(None, self.root.id))
+
+    def test_can_move_folder(self):
+        self.assertTrue(auth.canMoveFolder(self.user.id, self.child.id, self.other.id))
+        self.assertTrue(auth.canMoveFolder(self.user.id, self.child.id, None))
+        self.assertFalse(auth.canMoveFolder(self.user.id, self.child.id, self.child.id))
+        self.assertFalse(auth.canMoveFolder(self.user.id, self.root.id, self.leaf.id))
+
+    @override_settings(FOLDER_TREE_CACHE=True)
+    def test_cached_tree(self):
+        folders.tree.clear()
+        self.assertEqual(folders.ancestors(self.leaf.id), [self.leaf.id, self.child.id, self.root.id])
+        self.assertFalse(auth.canMoveFolder(self.user.id, self.root.id, self.leaf.id))
+        # kept up to date by signals.py
+        self.leaf.parent = self.other
+        self.leaf.save()
+        self.assertTrue(auth.canMoveFolder(self.user.id, self.root.id, self.leaf.id))
+        folders.tree.clear()
+
+    def test_cycle(self):
+        # nothing in the database prevents one: the queries must still end
+        M.Folder.objects.filter(pk=self.root.id).update(parent=self.leaf)
+        cycle = {self.root.id, self.child.id, self.leaf.id}
+        for cached in (False, True):
+            folders.tree.clear()
+            with self.settings(FOLDER_TREE_CACHE=cached):
+                self.assertEqual(set(folders.ancestors(self.leaf.id)), cycle)
+                self.assertEqual(set(folders.descendants(self.root.id)), cycle)
+                self.assertTrue(folders.isDirOrParent(self.leaf.id, self.root.id))
+                self.assertFalse(folders.isDirOrParent(self.other.id, self.root.id))
+        folders.tree.clear()
+
+    def test_other_process(self):
+        cached, expired = folders.FolderTree(ttl=60), folders.FolderTree(ttl=0)
+        for t in (cached, expired):
+            self.assertEqual(t.parents(self.leaf.id)[self.leaf.id], self.child.id)
+        # moved by another process: no signal here
+        M.Folder.objects.filter(pk=self.leaf.id).update(parent=self.other)
+        self.assertEqual(cached.parents(self.leaf.id)[self.leaf.id], self.child.id)
+        self.assertEqual(expired.parents(self.leaf.id)[self.leaf.id], self.other.id)
+        # a copy: changing it doesn't change the tree
+        cached.parents(self.leaf.id)[self.leaf.id] = None
+        self.assertEqual(cached.parents(self.leaf.id)[self.leaf.id], self.child.id)
+
+
+class ChangesTests(TestCase):
+    def setUp(self):
+        resolver.clear()
+        self.ensemble = M.Ensemble.objects.create(name="class")
+        self.admin, self.student, self.tagged = [M.User.objects.create(email="%s@example.com" % n, valid=True)
+                                                 for n in ("admin", "student", "tagged")]
+        for u in (self.admin, self.student, self.tagged):
+            M.Membership.objects.create(user=u, ensemble=self.ensemble, admin=u == self.admin)
+        self.source = M.Source.objects.create()
+        self.location = M.Location.objects.create(source=self.source, ensemble=self.ensemble, x=0, y=0, w=10,
+                                                  h=10, page=1)
+
+    def comment(self, author, type, **kwargs):
+        return M.Comment.objects.create(location=self.location, author=author, type=type, body="text", **kwargs)
+
+    def visible(self, user):
+        comments, _, _, _ = views.changesSince(user.id, self.source.id, None)
+        return {c["id"] for c in comments}
+
+    def test_visibility(self):
+        private = self.comment(self.student, 1)
+        staff = self.comment(self.student, 2)
+        public = self.comment(self.admin, 3)
+        tag_private = self.comment(self.admin, 4)
+        M.Tag.objects.create(type=1, individual=self.tagged, comment=tag_private)
+        self.assertEqual(self.visible(self.student), {private.id, staff.id, public.id})
+        self.assertEqual(self.visible(self.tagged), {public.id, tag_private.id})
+        self.assertEqual(self.visible(self.admin), {staff.id, public.id, tag_private.id})
+
+    def test_deleted_bodies(self):
+        deleted = self.comment(self.admin, 3, deleted=True)
+        moderated = self.comment(self.admin, 3, moderated=True)
+        kept = self.comment(self.admin, 3)
+        comments, _, _, _ = views.changesSince(self.student.id, self.source.id, None)
+        self.assertEqual({c["id"]: c["body"] for c in comments}, {deleted.id: None, moderated.id: None,
+                                                                  kept.id: "text"})
+
+    def test_watermark(self):
+        _, _, _, watermark = views.changesSince(self.student.id, self.source.id, None)
+        self.assertIsNone(watermark)
+        c = self.comment(self.admin, 3)
+        comments, _, _, watermark = views.changesSince(self.student.id, self.source.id, None)
+        self.assertEqual([r["id"] for r in comments], [c.id])
+        comments, _, _, since = views.changesSince(self.student.id, self.source.id, watermark)
+        self.assertEqual(since, watermark)
+
+    @override_settings(SYNC_OVERLAP=5)
+    def test_late_commit(self):
+        first = self.comment(self.admin, 3)
+        _, _, _, watermark = views.changesSince(self.student.id, self.source.id, None)
+        # committed after the watermark was read, with an earlier mtime
+        late = self.comment(self.admin, 3)
+        M.Comment.objects.filter(pk=late.id).update(mtime=watermark - timedelta(seconds=1))
+        old = self.comment(self.admin, 3)
+        M.Comment.objects.filter(pk=old.id).update(mtime=watermark - timedelta(seconds=60))
+        comments, _, _, since = views.changesSince(self.student.id, self.source.id, watermark)
+        self.assertEqual({c["id"] for c in comments}, {first.id, late.id})
+        self.assertEqual(since, watermark)
+
+
+    def test_threads(self):
+        # marks and ratings go with their thread: the student's private one
+        # is only visible to the student
+        root = self.comment(self.student, 1)
+        mark = M.ThreadMark.objects.create(location=self.location, comment=root, user=self.student, type=1)
+        rating = M.ReplyRating.objects.create(threadmark=mark, comment=root, status=M.ReplyRating.TYPE_RESOLVED)
+        _, marks, ratings, _ = views.changesSince(self.student.id, self.source.id, None)
+        self.assertEqual(([m["id"] for m in marks], [r["id"] for r in ratings]), ([mark.id], [rating.id]))
+        self.assertNotIn("threadmark__location_id", ratings[0])
+        _, marks, ratings, watermark = views.changesSince(self.tagged.id, self.source.id, None)
+        self.assertEqual((marks, ratings), ([], []))
+        # the watermark still moves past them
+        self.assertEqual(watermark, M.ReplyRating.objects.get(pk=rating.id).mtime)
+
+
+class CommentsViewTests(TransactionTestCase):
+    # the polls don't run on the test's thread: the rows need to be committed
+    def setUp(self):
+        resolver.clear()
+        ensemble = M.Ensemble.objects.create(name="class")
+        self.user = M.User.objects.create(email="student@example.com", valid=True, confkey="ckey")
+        M.Membership.objects.create(user=self.user, ensemble=ensemble)
+        self.source = M.Source.objects.create()
+        M.Ownership.objects.create(source=self.source, ensemble=ensemble)
+        location = M.Location.objects.create(source=self.source, ensemble=ensemble, x=0, y=0, w=10, h=10, page=1)
+        self.comment = M.Comment.objects.create(location=location, author=self.user, type=3, body="text")
+        self.client.cookies["ckey"] = "ckey"
+
+    def get(self, id_source, **params):
+        return self.client.get("/api/comments/%s" % id_source, params)
+
+    def test_params(self):
+        response = self.get(self.source.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c["id"] for c in response.json()["comments"]], [self.comment.id])
+        # no time zone: the server's
+        since = self.comment.mtime + timedelta(seconds=60)
+        self.assertTrue(timezone.is_naive(since))
+        response = self.get(self.source.id, since=since.isoformat())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["comments"], [])
+        for wait in ("nan", "inf", "-inf", "soon"):
+            self.assertEqual(self.get(self.source.id, wait=wait).status_code, 400)
+        self.assertEqual(self.get(self.source.id, since="yesterday").status_code, 400)
+        # no such source
+        self.assertEqual(self.get(self.source.id + 1).status_code, 403)
+
+    @override_settings(POLL_INTERVAL=0.05)
+    def test_load(self):
+        # concurrent long polls must not wait for each other's queries
+        polls, delay = 8, 0.2
+        running, peak = [0], [0]
+        lock = threading.Lock()
+
+        def changesSince(uid, id_source, since):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(delay)
+            with lock:
+                running[0] -= 1
+            return [], [], [], since
+
+        request = RequestFactory().get("/api/comments/%s" % self.source.id, {"wait": 0})
+        request.COOKIES["ckey"] = "ckey"
+
+        async def poll():
+            return await asyncio.gather(*[views.comments(request, self.source.id) for _ in range(polls)])
+
+        with mock.patch.object(views, "changesSince", changesSince):
+            t0 = time.monotonic()
+            responses = async_to_sync(poll)()
+            elapsed = time.monotonic() - t0
+        self.assertEqual([r.status_code for r in responses], [200] * polls)
+        self.assertGreater(peak[0], 1)
+        self.assertLess(elapsed, polls * delay / 2)
+
+
+@override_settings(PASSWORD_HASH_ITERATIONS=1000)
+class CheckUserTests(TestCase):
+    def setUp(self):
+        self.user = M.User(email="Ada@example.com", valid=True)
+        self.user.set_password("secret")
+        self.user.save()
+
+    def test_exact(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(auth.checkUser(" Ada@example.com ", "secret"), self.user)
+        self.assertIsNone(auth.checkUser("Ada@example.com", "wrong"))
+
+    def test_case_insensitive(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(auth.checkUser("ada@EXAMPLE.com", "secret"), self.user)
+        M.User.objects.create(email="ADA@example.com", valid=True)
+        # ambiguous
+        self.assertIsNone(auth.checkUser("ada@example.com", "secret"))
+        # but an exact match wins
+        with self.assertNumQueries(1):
+            self.assertEqual(auth.checkUser("Ada@example.com", "secret"), self.user)
+
+    @override_settings(PASSWORD_HASH_ITERATIONS=1000)
+    def test_legacy_hash(self):
+        # a row from before hashers.py: hex SHA-512 of password + salt
+        M.User.objects.filter(pk=self.user.id).update(
+            saltedhash=hashlib.sha512(("secret" + self.user.salt).encode("ascii")).hexdigest())
+        # + saving the upgraded hash
+        with self.assertNumQueries(2):
+            self.assertEqual(auth.checkUser("Ada@example.com", "secret"), self.user)
+        saltedhash = M.User.objects.get(pk=self.user.id).saltedhash
+        self.assertTrue(saltedhash.startswith("pbkdf2_sha256$1000$"))
+        self.assertEqual(auth.checkUser("Ada@example.com", "secret"), self.user)
+        self.assertIsNone(auth.checkUser("Ada@example.com", "wrong"))
+
+    def test_guest(self):
+        guest = auth.createGuest()
+        self.assertTrue(guest.guest)
+        self.assertIsNone(guest.saltedhash)
+        self.assertFalse(guest.authenticate(""))
+        self.assertEqual(auth.getCkeyInfo(guest.confkey), guest)
+
+
+@override_settings(GUEST_POOL_SIZE=10, GUEST_POOL_MIN=0)
+class GuestPoolTests(TestCase):
+    def test_claim(self):
+        pool = guests.GuestPool()
+        pool.createGuests(3)
+        # don't refill from a background thread
+        pool._available = 3
+        claimed = [pool.claim() for _ in range(3)]
+        self.assertEqual(len({u.id for u in claimed}), 3)
+        self.assertTrue(all(u.guest and u.saltedhash is None for u in claimed))
+        self.assertFalse(M.GuestHistory.objects.filter(t_start=None).exists())
+        self.assertIsNone(pool.claim())
+
+
+class ActivityTests(TestCase):
+    def setUp(self):
+        self.t0 = datetime(2020, 1, 1, 12, 0)
+        user = M.User.objects.create(email="a@example.com")
+        self.session = M.Session.objects.create(user=user, lastactivity=self.t0)
+
+    def tracker(self):
+        tracker = activity.ActivityTracker(flush_interval=3600, max_staleness=3600, idle_threshold=300)
+        self.addCleanup(tracker.stop)
+        return tracker
+
+    def lastactivity(self):
+        return timezone.make_naive(M.Session.objects.get(pk=self.session.id).lastactivity)
+
+    def test_idle(self):
+        tracker = self.tracker()
+        tracker.touch(self.session.id, self.t0 + timedelta(minutes=10))
+        tracker.touch(self.session.id, self.t0 + timedelta(minutes=11))
+        tracker.flush()
+        self.assertEqual(self.lastactivity(), self.t0 + timedelta(minutes=11))
+        idle = M.Idle.objects.get(session=self.session)
+        self.assertEqual((timezone.make_naive(idle.t1), timezone.make_naive(idle.t2)),
+                         (self.t0, self.t0 + timedelta(minutes=10)))
+
+    def test_other_process(self):
+        # another worker already wrote a later activity
+        a, b = self.tracker(), self.tracker()
+        a.touch(self.session.id, self.t0 + timedelta(minutes=2))
+        b.touch(self.session.id, self.t0 + timedelta(minutes=4))
+        b.flush()
+        a.flush()
+        self.assertEqual(self.lastactivity(), self.t0 + timedelta(minutes=4))
+        self.assertFalse(M.Idle.objects.exists())
+
+
+class UnreadTests(TestCase):
+    def setUp(self):
+        self.ensemble = M.Ensemble.objects.create(name="class")
+        self.author, self.reader = [M.User.objects.create(email="%s@example.com" % n) for n in ("author", "reader")]
+        self.source = M.Source.objects.create()
+        M.Ownership.objects.create(source=self.source, ensemble=self.ensemble)
+        self.location = M.Location.objects.create(source=self.source, ensemble=self.ensemble, x=0, y=0, w=10,
+                                                  h=10, page=1)
+        self.buffer = seen.WriteBehindBuffer(M.CommentSeen, after_write=unread.commentsSeen)
+
+    def comment(self, type=3):
+        return M.Comment.objects.create(location=self.location, author=self.author, type=type, body="text")
+
+    def see(self, *comments):
+        for c in comments:
+            self.buffer.put(M.CommentSeen(comment=c, user=self.reader))
+        self.buffer.flush()
+
+    def unread(self):
+        return unread.folderUnread(self.reader.id, self.ensemble.id)
+
+    def test_counts(self):
+        public, other = self.comment(), self.comment()
+        self.comment(type=1)
+        self.comment(type=2)
+        self.comment(type=4)
+        self.assertEqual(self.unread(), {self.source.id: 2})
+        # seeing the same comment twice counts once
+        self.see(public, public)
+        self.see(public)
+        self.assertEqual(self.unread(), {self.source.id: 1})
+        self.see(other)
+        self.assertEqual(self.unread(), {self.source.id: 0})
+        other.deleted = True
+        other.save()
+        self.assertEqual(self.unread(), {self.source.id: 0})
+        self.assertEqual(M.PageSeenCount.objects.get(user=self.reader).seen, 1)
+        public.delete()
+        self.assertEqual(M.PageCommentCount.objects.get(source=self.source).total, 0)
+        self.assertEqual(M.PageSeenCount.objects.get(user=self.reader).seen, 0)
+
+    def test_edit(self):
+        public = self.comment()
+        readers = [M.User.objects.create(email="reader%s@example.com" % i) for i in range(20)]
+        M.CommentSeen.objects.bulk_create([M.CommentSeen(comment=public, user=u) for u in readers])
+        # + the old type/deleted, and the location: no recount
+        public.body = "edited"
+        with self.assertNumQueries(3):
+            public.save()
+        public.type = 1
+        public.save()
+        self.assertEqual(M.PageCommentCount.objects.get(source=self.source).total, 0)
+        self.assertEqual(M.PageSeenCount.objects.filter(seen=0).count(), len(readers))
+        public.type = 3
+        public.save()
+        self.assertEqual(M.PageCommentCount.objects.get(source=self.source).total, 1)
+        self.assertEqual(M.PageSeenCount.objects.filter(seen=1).count(), len(readers))
+
+    def test_failed_write(self):
+        self.comment()
+        self.buffer.put(M.CommentSeen(comment_id=None, user_id=self.reader.id))
+        with self.assertLogs(level="ERROR"):
+            self.buffer.flush()
+        self.assertFalse(M.PageSeenCount.objects.exists())
+
+    def test_rebuild(self):
+        public = self.comment()
+        self.comment(type=1)
+        self.see(public)
+        M.PageCommentCount.objects.all().delete()
+        M.PageSeenCount.objects.all().delete()
+        unread.rebuild(self.source.id)
+        self.assertEqual(M.PageCommentCount.objects.get(source=self.source).total, 1)
+        self.assertEqual(M.PageSeenCount.objects.get(user=self.reader).seen, 1)
+
+
+MEMBERSHIP = ("ensemble_id", "admin", "guest")
+ENSEMBLE = ("id", "allow_staffonly", "allow_anonymous", "allow_tag_private", "allow_guest", "use_invitekey",
+            "allow_download", "allow_ondemand", "default_pause", "section_assignment", "metadata")
+
+
+class AuthQueryTests(TestCase):
+    """queries each check takes (columns and rows), with a cold permission cache"""
+
+    @contextmanager
+    def assertTransfers(self, *expected):
+        # expected: (selected columns, number of rows) for each query. The
+        # captured queries are run again to count the rows they return
+        with CaptureQueriesContext(connection) as ctx:
+            yield
+        got = []
+        for q in ctx.captured_queries:
+            with connection.cursor() as c:
+                c.execute(q["sql"])
+                got.append((tuple(d[0] for d in c.description), len(c.fetchall())))
+        self.assertEqual(got, list(expected))
+
+    def setUp(self):
+        self.ensemble = M.Ensemble.objects.create(name="class", allow_download=False)
+        self.admin, self.student = [M.User.objects.create(email="%s@example.com" % n, valid=True)
+                                    for n in ("admin", "student")]
+        M.Membership.objects.create(user=self.admin, ensemble=self.ensemble, admin=True)
+        M.Membership.objects.create(user=self.student, ensemble=self.ensemble)
+        self.source = M.Source.objects.create()
+        M.Ownership.objects.create(source=self.source, ensemble=self.ensemble)
+        self.location = M.Location.objects.create(source=self.source, ensemble=self.ensemble, x=0, y=0, w=10,
+                                                  h=10, page=1)
+        self.comment = M.Comment.objects.create(location=self.location, author=self.student, type=3)
+        self.folder = M.Folder.objects.create(ensemble=self.ensemble, name="folder")
+        M.Invite.objects.create(key="key", user=self.student, ensemble=self.ensemble)
+        resolver.clear()
+
+    def test_read(self):
+        with self.assertTransfers((MEMBERSHIP, 1), (("ensemble_id", "deleted"), 1)):
+            self.assertTrue(auth.canReadFile(self.student.id, self.source.id))
+        # cached
+        with self.assertTransfers():
+            self.assertTrue(auth.canReadFile(self.student.id, self.source.id))
+            self.assertTrue(auth.isMember(self.student.id, self.ensemble.id))
+
+    def test_download(self):
+        with self.assertTransfers((("ensemble_id", "deleted"), 1), (MEMBERSHIP, 1)):
+            self.assertTrue(auth.canDownloadPDF(self.admin.id, self.source.id))
+        # + the ensemble settings, and the guest fallback
+        with self.assertTransfers((MEMBERSHIP, 1), (ENSEMBLE, 1), (("ensemble_id",), 1)):
+            self.assertFalse(auth.canDownloadPDF(self.student.id, self.source.id))
+        with self.assertTransfers():
+            self.assertTrue(auth.canDownloadFileComments(self.admin.id, self.source.id))
+
+    def test_invites(self):
+        with self.assertTransfers((("user_id",), 1)):
+            self.assertEqual(auth.invite2uid("key"), self.student.id)
+        with self.assertTransfers((("id", "key", "user_id", "ensemble_id", "admin", "ctime", "section_id"), 1),
+                                  (MEMBERSHIP, 1)):
+            self.assertIsNotNone(auth.confirmInvite("key"))
+
+    def test_annotate(self):
+        with self.assertTransfers((MEMBERSHIP, 1)):
+            self.assertTrue(auth.canAnnotate(self.student.id, self.ensemble.id))
+        with self.assertTransfers((("ensemble_id",), 1), (("ensemble_id",), 1), (MEMBERSHIP, 1)):
+            self.assertTrue(auth.canImportAnnotation(self.admin.id, self.source.id, self.source.id))
+        with self.assertTransfers((("ensemble_id",), 1)):
+            self.assertTrue(auth.canAdministrateLocation(self.admin.id, self.location.id))
+
+    def test_comments(self):
+        # the author, and whether the comment has replies
+        with self.assertTransfers((("author_id",), 1), (("a",), 0)):
+            self.assertTrue(auth.canEdit(self.student.id, self.comment.id))
+        with self.assertTransfers((("author_id", "type", "ensemble_id"), 1)):
+            self.assertTrue(auth.canMarkThread(self.student.id, self.location.id))
+        with self.assertTransfers((("author_id", "type", "ensemble_id"), 1), (MEMBERSHIP, 1)):
+            self.assertTrue(auth.canMarkThread(self.admin.id, self.location.id))
+
+    def test_folders(self):
+        # + whether the folder holds sources or subfolders
+        with self.assertTransfers((("ensemble_id",), 1), (MEMBERSHIP, 1), (("a",), 0), (("a",), 0)):
+            self.assertTrue(auth.canDeleteFolder(self.admin.id, self.folder.id))
+        # memberships are cached by now; + the recursive query
+        with self.assertTransfers((("ensemble_id",), 1), (("COUNT(*)",), 1)):
+            self.assertFalse(auth.canMoveFolder(self.admin.id, self.folder.id, self.folder.id))
+
+
+class BatchAuthTests(TestCase):
+    """the batch checks take one query each and agree with the checks they batch"""
+
+    def setUp(self):
+        mine, other, open_ = [M.Ensemble.objects.create(name=n, allow_guest=n == "open")
+                              for n in ("mine", "other", "open")]
+        self.admin, self.student = [M.User.objects.create(email="%s@example.com" % n, valid=True)
+                                    for n in ("admin", "student")]
+        M.Membership.objects.create(user=self.admin, ensemble=mine, admin=True)
+        M.Membership.objects.create(user=self.student, ensemble=mine)
+        self.sources, self.locations, self.comments = [], [], []
+        for e in (mine, other, open_, mine):
+            source = M.Source.objects.create()
+            # the last one was removed from mine
+            M.Ownership.objects.create(source=source, ensemble=e, deleted=len(self.sources) == 3)
+            location = M.Location.objects.create(source=source, ensemble=e, x=0, y=0, w=10, h=10, page=1)
+            self.sources.append(source.id)
+            self.locations.append(location.id)
+            self.comments.append(M.Comment.objects.create(location=location, author=self.student, type=3).id)
+        resolver.clear()
+
+    def test_batches(self):
+        for u in (self.admin, self.student):
+            resolver.clear()
+            with self.assertNumQueries(2):
+                readable = auth.readable_sources(u.id, self.sources)
+            # memberships are cached by now (and with no admin membership,
+            # there is nothing to look up)
+            with self.assertNumQueries(2 if u is self.admin else 0):
+                labelable = auth.labelable_comments(u.id, self.comments)
+                administrable = auth.administrable_locations(u.id, self.locations)
+            self.assertEqual(readable, {i for i in self.sources if auth.canReadFile(u.id, i)})
+            self.assertEqual(labelable, {i for i in self.comments if auth.canLabelComment(u.id, i)})
+            self.assertEqual(administrable, {i for i in self.locations if auth.canAdministrateLocation(u.id, i)})
+        self.assertEqual(auth.administrable_locations(self.admin.id, self.locations), {self.locations[0],
+                                                                                      self.locations[3]})
+
+
+class ThreadTests(TestCase):
+    def setUp(self):
+        ensemble = M.Ensemble.objects.create(name="class")
+        self.author, self.other = [M.User.objects.create(email="%s@example.com" % n) for n in ("author", "other")]
+        self.source = M.Source.objects.create()
+        self.locations = [M.Location.objects.create(source=self.source, ensemble=ensemble, x=10 * i, y=0, w=5,
+                                                    h=5, page=1 + i % 2) for i in range(4)]
+        for loc in self.locations:
+            root = M.Comment.objects.create(location=loc, author=self.author, type=3)
+            M.Comment.objects.create(location=loc, parent=root, author=self.other, type=3)
+            mark = M.ThreadMark.objects.create(location=loc, comment=root, user=self.other, type=1)
+            M.ReplyRating.objects.create(threadmark=mark, comment=root, status=M.ReplyRating.TYPE_RESOLVED)
+
+    def test_load(self):
+        with self.assertNumQueries(4):
+            loaded, ratings = threads.loadThreads(self.source.id)
+        self.assertEqual(set(loaded), {loc.id for loc in self.locations})
+        thread = loaded[self.locations[0].id]
+        self.assertEqual(len(thread.root.children), 1)
+        self.assertEqual(len(ratings[thread.marks[0].id]), 1)
+        # the reply isn't deleted: same answer as auth.canEdit
+        self.assertFalse(thread.canEdit(self.author.id, thread.root.id))
+        self.assertEqual(thread.canEdit(self.author.id, thread.root.id), auth.canEdit(self.author.id,
+                                                                                      thread.root.id))
+        with self.assertNumQueries(4):
+            loaded, _ = threads.loadThreads(self.source.id, pages=[1])
+        self.assertEqual(len(loaded), 2)
+
+
+class SpatialTests(TestCase):
+    def test_page(self):
+        ensemble = M.Ensemble.objects.create(name="class")
+        source = M.Source.objects.create()
+        a = M.Location.objects.create(source=source, ensemble=ensemble, x=0, y=0, w=10, h=10, page=1)
+        b = M.Location.objects.create(source=source, ensemble=ensemble, x=500, y=500, w=10, h=10, page=1)
+        indexes.clear()
+        with self.assertNumQueries(1):
+            index = indexes.page(source.id, 1, 1)
+            index = indexes.page(source.id, 1, 1)
+        self.assertEqual(set(index.intersecting(5, 5, 1, 1)), {a.id})
+        # moved, through signals.py
+        b.x, b.y = 0, 0
+        b.save()
+        self.assertEqual(set(indexes.page(source.id, 1, 1).intersecting(5, 5, 1, 1)), {a.id, b.id})
+        indexes.clear()
+
+    def test_nearest(self):
+        # against a brute force search, on random pages (negative
+        # coordinates, rectangles spanning cells, points far off the page)
+        rnd = random.Random(42)
+        for _ in range(50):
+            index = PageIndex(cell=rnd.choice((8, 64, 256)))
+            rects = {}
+            for id in range(rnd.randint(1, 60)):
+                rects[id] = (rnd.randint(-200, 1000), rnd.randint(-200, 1000), rnd.randint(0, 300),
+                             rnd.randint(0, 300))
+                index.add(id, *rects[id])
+            for id in rnd.sample(list(rects), len(rects) // 4):
+                index.remove(id)
+                del rects[id]
+            for _ in range(20):
+                x, y = rnd.uniform(-2000, 3000), rnd.uniform(-2000, 3000)
+                expected = min(((id, math.hypot(max(rx - x, 0, x - rx - rw), max(ry - y, 0, y - ry - rh)))
+                                for id, (rx, ry, rw, rh) in rects.items()), key=lambda e: (e[1], e[0]),
+                               default=None)
+                got = index.nearest(x, y)
+                if expected is None:
+                    self.assertIsNone(got)
+                else:
+                    self.assertEqual(got[0], expected[0])
+                    self.assertAlmostEqual(got[1], expected[1])
+
+
+class AnchorTests(TestCase):
+    def test_within(self):
+        index = AnchorIndex([
+            (1, "/html/body/div[1]/p[1]", 0, "/html/body/div[1]/p[1]", 10),
+            # nested: deeper under div[1]
+            (2, "/html/body/div[1]/p[2]/span", 3, "/html/body/div[1]/p[2]/span/b", 1),
+            # from div[1] into div[2]: leaves the subtree of div[1]
+            (3, "/html/body/div[1]/p[2]", 5, "/html/body/div[2]/p", 2),
+            # div[10] isn't under div[1]
+            (4, "/html/body/div[10]", 0, "/html/body/div[10]", 4),
+            # same path, written differently
+            (5, "html/body//div[2]/p/", 0, "/html/body/div[2]/p", 1),
+        ])
+        self.assertEqual(sorted(index.within("/html/body/div[1]")), [1, 2])
+        self.assertEqual(sorted(index.within("/html/body/div[1]/p[2]")), [2])
+        self.assertEqual(sorted(index.within("/html/body/div[2]")), [5])
+        self.assertEqual(sorted(index.within("/html/body")), [1, 2, 3, 4, 5])
+        self.assertEqual(sorted(index.within("/")), [1, 2, 3, 4, 5])
+        # unknown paths
+        self.assertEqual(index.within("/html/body/div[3]"), [])
+        self.assertEqual(index.within("/html/body/div[1]/p[1]/span"), [])
+        self.assertEqual(next(a for a in index.anchors() if a[0] == 5),
+                         (5, "/html/body/div[2]/p", 0, "/html/body/div[2]/p", 1))
+
+
+# stands for processing.analyze in the worker processes (forked, so they
+# see CRASH_ON as set by the test)
+CRASH_ON = None
+
+
+def analyzeOrCrash(path):
+    if os.path.basename(path) == CRASH_ON:
+        os._exit(1)
+    return {"numpages": 1}
+
+
+@override_settings(PDF_JOB_LEASE=600, PDF_MAX_ATTEMPTS=2)
+class ProcessingTests(TestCase):
+    def setUp(self):
+        self.source = M.Source.objects.create()
+        self.job = M.Processqueue.objects.create(source=self.source)
+
+    def test_retry_then_fail(self):
+        self.assertEqual(processing.claim(), (self.job.id, self.source.id))
+        self.assertIsNone(processing.claim())
+        self.assertEqual(processing.stats()["running"], 1)
+        processing.fail(self.job.id)
+        self.assertEqual(processing.stats()["depth"], 1)
+        self.assertEqual(processing.claim(), (self.job.id, self.source.id))
+        processing.fail(self.job.id)
+        self.assertIsNone(processing.claim())
+        s = processing.stats()
+        self.assertEqual((s["depth"], s["running"], s["failed"]), (0, 0, 1))
+
+    def test_lease(self):
+        self.assertEqual(processing.claim(), (self.job.id, self.source.id))
+        # the worker died
+        M.Processqueue.objects.filter(pk=self.job.id).update(started=datetime.now() - timedelta(seconds=601))
+        self.assertEqual(processing.stats()["running"], 0)
+        self.assertEqual(processing.claim(), (self.job.id, self.source.id))
+        M.Processqueue.objects.filter(pk=self.job.id).update(started=datetime.now() - timedelta(seconds=601))
+        self.assertIsNone(processing.claim())
+        self.assertEqual(processing.reap(), 1)
+        self.assertIsNotNone(M.Processqueue.objects.get(pk=self.job.id).failed)
+
+    def test_worker_crash(self):
+        global CRASH_ON
+        other = M.Source.objects.create()
+        M.Processqueue.objects.create(source=other)
+        CRASH_ON = str(self.source.id)
+        try:
+            with mock.patch.object(processing, "analyze", analyzeOrCrash), self.assertLogs(level="ERROR"):
+                processing.run(workers=1, once=True, poll=0.1)
+        finally:
+            CRASH_ON = None
+        # both attempts crashed, the pool was started again for the other job
+        self.assertIsNotNone(M.Processqueue.objects.get(pk=self.job.id).failed)
+        self.assertEqual(M.Processqueue.objects.get(pk=self.job.id).attempts, 2)
+        self.assertEqual(M.Source.objects.get(pk=other.id).numpages, 1)
+
+    def test_complete(self):
+        id_job, id_source = processing.claim()
+        processing.complete(id_job, id_source, {"numpages": 3})
+        self.assertEqual(M.Source.objects.get(pk=id_source).numpages, 3)
+        self.assertIsNone(processing.claim())
+        self.assertEqual(processing.stats()["running"], 0)
+
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+
+@unittest.skipIf(fitz is None, "needs PyMuPDF")
+class ExportTests(TestCase):
+    def setUp(self):
+        self.repository = tempfile.TemporaryDirectory()
+        self.addCleanup(self.repository.cleanup)
+        self.enterContext(override_settings(PDF_REPOSITORY=self.repository.name))
+        ensemble = M.Ensemble.objects.create(name="class")
+        self.admin = M.User.objects.create(email="admin@example.com", confkey="ckey", valid=True)
+        M.Membership.objects.create(user=self.admin, ensemble=ensemble, admin=True)
+        self.source = M.Source.objects.create(numpages=3, w=600, h=800)
+        M.Ownership.objects.create(source=self.source, ensemble=ensemble)
+        with fitz.open() as doc:
+            for _ in range(3):
+                doc.new_page(width=600, height=800)
+            doc.save(processing.pdfPath(self.source.id))
+        for page, n in ((1, 2), (3, 1)):
+            loc = M.Location.objects.create(source=self.source, ensemble=ensemble, x=10, y=10, w=50, h=20,
+                                            page=page)
+            for i in range(n):
+                M.Comment.objects.create(location=loc, author=self.admin, type=3, body="comment %s" % i)
+            M.Comment.objects.create(location=loc, author=self.admin, type=1, body="private")
+            M.Comment.objects.create(location=loc, author=self.admin, type=3, body="moderated", moderated=True)
+        # another class sharing the source
+        other = M.Ensemble.objects.create(name="other")
+        M.Ownership.objects.create(source=self.source, ensemble=other)
+        self.student = M.User.objects.create(email="student@example.com", valid=True)
+        M.Membership.objects.create(user=self.student, ensemble=other)
+        loc = M.Location.objects.create(source=self.source, ensemble=other, x=10, y=10, w=50, h=20, page=2)
+        M.Comment.objects.create(location=loc, author=self.student, type=3, body="other class")
+        resolver.clear()
+
+    def notes(self, uid):
+        dest = "%s/out.pdf" % self.repository.name
+        export.exportAnnotated(self.source.id, dest, uid)
+        with fitz.open(dest) as doc:
+            return [[a.info["content"] for a in page.annots()] for page in doc]
+
+    def test_export(self):
+        self.assertEqual(self.notes(self.admin.id), [["comment 0\n\ncomment 1"], [], ["comment 0"]])
+        # admin nowhere: a plain copy
+        self.assertEqual(self.notes(self.student.id), [[], [], []])
+
+    def test_view(self):
+        self.client.cookies["ckey"] = "ckey"
+        response = self.client.get("/api/pdf/%s/annotated" % self.source.id)
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content)
+        self.assertEqual(int(response["Content-Length"]), len(content))
+        with fitz.open(stream=content, filetype="pdf") as doc:
+            self.assertEqual(doc.page_count, 3)
+        response.close()
+        self.assertTrue(M.FileDownload.objects.filter(user=self.admin, annotated=True).exists())
+
+
+class DeliveryTests(TestCase):
+    def setUp(self):
+        repository = tempfile.TemporaryDirectory()
+        self.addCleanup(repository.cleanup)
+        self.enterContext(override_settings(PDF_REPOSITORY=repository.name))
+        ensemble = M.Ensemble.objects.create(name="class", allow_download=True)
+        self.user = M.User.objects.create(email="student@example.com", confkey="ckey", valid=True)
+        M.Membership.objects.create(user=self.user, ensemble=ensemble)
+        self.source = M.Source.objects.create()
+        M.Ownership.objects.create(source=self.source, ensemble=ensemble)
+        self.data = bytes(range(256)) * 4
+        with open(processing.pdfPath(self.source.id), "wb") as f:
+            f.write(self.data)
+        self.client.cookies["ckey"] = "ckey"
+        resolver.clear()
+
+    def get(self, id_source=None, **headers):
+        response = self.client.get("/api/pdf/%s" % (id_source or self.source.id), **headers)
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_whole(self):
+        response, content = self.get()
+        self.assertEqual((response.status_code, content), (200, self.data))
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(M.FileDownload.objects.filter(user=self.user, annotated=False).count(), 1)
+
+    def test_ranges(self):
+        for header, start, end in (("bytes=10-19", 10, 19), ("bytes=1000-", 1000, 1023),
+                                   ("bytes=-100", 924, 1023), ("bytes=-5000", 0, 1023),
+                                   ("bytes=1000-5000", 1000, 1023)):
+            response, content = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response["Content-Range"], "bytes %s-%s/1024" % (start, end))
+            self.assertEqual(int(response["Content-Length"]), end - start + 1)
+            self.assertEqual(content, self.data[start:end + 1])
+        # several ranges: the whole file
+        self.assertEqual(self.get(HTTP_RANGE="bytes=0-1,5-6")[0].status_code, 200)
+        # requests with a Range aren't logged as downloads
+        self.assertFalse(M.FileDownload.objects.exists())
+
+    def test_unsatisfiable(self):
+        for header in ("bytes=1024-", "bytes=-0", "bytes=20-10"):
+            response, _ = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response["Content-Range"], "bytes */1024")
+
+    def test_conditional(self):
+        tag = self.get()[0]["ETag"]
+        response, content = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE=tag)
+        self.assertEqual((response.status_code, content), (206, self.data[:10]))
+        # another version: the whole file
+        response, content = self.get(HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"pdf-0-0"')
+        self.assertEqual((response.status_code, content), (200, self.data))
+        response, content = self.get(HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual((response.status_code, content, response["ETag"]), (304, b"", tag))
+        M.Source.objects.filter(pk=self.source.id).update(version=1)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=tag)[0].status_code, 200)
+
+    def test_unknown(self):
+        unowned = M.Source.objects.create()
+        self.assertEqual(self.get(unowned.id)[0].status_code, 403)
+        self.assertEqual(self.get(unowned.id + 1)[0].status_code, 403)
+        del self.client.cookies["ckey"]
+        self.assertEqual(self.get()[0].status_code, 403)
+
+
+@unittest.skipIf(fitz is None, "needs PyMuPDF")
+class RenderTests(TestCase):
+    def setUp(self):
+        repository = tempfile.TemporaryDirectory()
+        self.addCleanup(repository.cleanup)
+        self.enterContext(override_settings(PDF_REPOSITORY=repository.name, RENDER_PREWARM=0))
+        ensemble = M.Ensemble.objects.create(name="class")
+        user = M.User.objects.create(email="student@example.com", confkey="ckey", valid=True)
+        M.Membership.objects.create(user=user, ensemble=ensemble)
+        self.source = M.Source.objects.create(numpages=2)
+        M.Ownership.objects.create(source=self.source, ensemble=ensemble)
+        with fitz.open() as doc:
+            doc.new_page(width=600, height=800)
+            doc.new_page(width=600, height=800).set_rotation(90)
+            doc.save(processing.pdfPath(self.source.id))
+        self.renderer = render.Renderer(render.PageCache(os.path.join(repository.name, "cache")), workers=1)
+        self.addCleanup(lambda: self.renderer._pool and self.renderer._pool.shutdown())
+
+    def size(self, path):
+        pix = fitz.Pixmap(path)
+        return pix.width, pix.height
+
+    def test_page(self):
+        self.assertEqual(self.size(self.renderer.page(self.source.id, 1, 72)), (600, 800))
+        # /Rotate is applied once
+        self.assertEqual(self.size(self.renderer.page(self.source.id, 2, 72)), (800, 600))
+        self.assertEqual(self.size(self.renderer.page(self.source.id, 1, 144)), (1200, 1600))
+        self.assertIsNone(self.renderer.page(self.source.id, 3, 72))
+        self.assertIsNone(self.renderer.page(self.source.id + 1, 1, 72))
+
+    def test_broken_pool(self):
+        # a rendering process died
+        broken = self.renderer._executor()
+        broken.submit(os._exit, 1).exception()
+        self.assertEqual(self.size(self.renderer.page(self.source.id, 1, 72)), (600, 800))
+        self.assertIsNot(self.renderer._pool, broken)
+
+    def test_view(self):
+        url = "/api/pdf/%s/page/%%s" % self.source.id
+        with mock.patch.object(delivery, "renderer", self.renderer):
+            self.assertEqual(self.client.get(url % 2).status_code, 403)
+            self.client.cookies["ckey"] = "ckey"
+            response = self.client.get(url % 2, {"resolution": 72})
+            self.assertEqual((response.status_code, response["Content-Type"]), (200, "image/png"))
+            pix = fitz.Pixmap(b"".join(response.streaming_content))
+            self.assertEqual((pix.width, pix.height), (800, 600))
+            response.close()
+            self.assertEqual(self.client.get(url % 2, {"resolution": 300}).status_code, 400)
+            self.assertEqual(self.client.get(url % 3).status_code, 404)
+
+
+class TimelineTests(TestCase):
+    def setUp(self):
+        self.ensemble = M.Ensemble.objects.create(name="class", default_pause=True)
+        self.admin, self.student = [M.User.objects.create(email="%s@example.com" % n) for n in ("admin", "student")]
+        self.source = M.Source.objects.create(type=M.Source.TYPE_YOUTUBE)
+        timelines.clear()
+
+    def location(self, t, type, pause=False, duration=5):
+        loc = M.Location.objects.create(source=self.source, ensemble=self.ensemble, x=0, y=0, w=0, h=0, page=t,
+                                        duration=duration, pause=pause)
+        M.Comment.objects.create(location=loc, author=self.admin, type=type)
+        return loc
+
+    def test_pauses(self):
+        staff = self.location(10, 2)
+        flagged = self.location(20, 3, pause=True)
+        self.location(30, 3)
+        with self.assertNumQueries(1):
+            timeline = timelines.source(self.source.id)
+        self.assertEqual(timeline.pauses(0, 100), [staff.id, flagged.id])
+        self.assertEqual(timeline.nextPause(10), 20)
+        self.assertEqual(sorted(timeline.active(12)), [staff.id])
+        # cleared through signals.py
+        self.ensemble.default_pause = False
+        self.ensemble.save()
+        self.assertEqual(timelines.source(self.source.id).pauses(0, 100), [flagged.id])
+
+    def test_root_comment(self):
+        loc = self.location(10, 3)
+        self.assertEqual(timelines.source(self.source.id).pauses(0, 100), [])
+        M.Comment.objects.filter(location=loc).update(type=2)
+        M.Comment.objects.get(location=loc).save()
+        self.assertEqual(timelines.source(self.source.id).pauses(0, 100), [loc.id])
+
+
+class EnsembleSettingsTests(TestCase):
+    def test_invalidate(self):
+        a = M.Ensemble.objects.create(name="a", allow_guest=False, metadata='{"k": 1}')
+        b = M.Ensemble.objects.create(name="b")
+        resolver.clear()
+        with self.assertNumQueries(2):
+            self.assertFalse(resolver.ensemble(a.id).allow_guest)
+            resolver.ensemble(b.id)
+        self.assertEqual(resolver.ensemble(a.id).metadata["k"], 1)
+        a.allow_guest = True
+        a.save()
+        # only a was dropped
+        with self.assertNumQueries(1):
+            self.assertTrue(resolver.ensemble(a.id).allow_guest)
+            resolver.ensemble(b.id)
+
+
+class InvalidateOnCommitTests(TransactionTestCase):
+    def test_on_commit(self):
+        u = M.User.objects.create(email="a@example.com")
+        e = M.Ensemble.objects.create(name="class")
+        with mock.patch.object(resolver, "invalidateUser") as invalidateUser:
+            with transaction.atomic():
+                M.Membership.objects.create(user=u, ensemble=e)
+                invalidateUser.assert_called_once_with(u.id)
+            # other threads may have cached the old memberships in between
+            self.assertEqual(invalidateUser.call_count, 2)
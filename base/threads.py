@@ -0,0 +1,106 @@
+"""
+threads.py - Loads all the comment threads of a source at once
+
+loadThreads(id_source) fetches the locations, comments, threadmarks and
+reply ratings of a source (optionally restricted to some pages) in four
+queries and assembles them in memory, instead of following Comment.parent
+and Location one query at a time.
+"""
+from collections import namedtuple
+
+from . import models as M
+
+LOCATION_FIELDS = ("id", "ensemble_id", "section_id", "page", "x", "y", "w", "h",
+                   "duration", "is_title", "pause")
+COMMENT_FIELDS = ("id", "location_id", "parent_id", "author_id", "ctime", "body", "type",
+                  "signed", "deleted", "moderated")
+THREADMARK_FIELDS = ("id", "location_id", "comment_id", "user_id", "type", "active", "ctime")
+REPLYRATING_FIELDS = ("id", "threadmark_id", "comment_id", "status", "ctime")
+
+LocationRow = namedtuple("LocationRow", LOCATION_FIELDS)
+ThreadMarkRow = namedtuple("ThreadMarkRow", THREADMARK_FIELDS)
+ReplyRatingRow = namedtuple("ReplyRatingRow", REPLYRATING_FIELDS)
+
+
+class CommentNode:
+    __slots__ = COMMENT_FIELDS + ("children",)
+
+    def __init__(self, *row):
+        for name, value in zip(COMMENT_FIELDS, row):
+            setattr(self, name, value)
+        self.children = []
+
+
+class Thread:
+    __slots__ = ("location", "root", "comments", "marks")
+
+    def __init__(self, location):
+        self.location = location
+        self.root = None
+        self.comments = {}  # id -> CommentNode
+        self.marks = []     # ThreadMarkRow
+
+    def canEdit(self, uid, id_comment):
+        """same as auth.canEdit, for a comment of this thread"""
+        c = self.comments[id_comment]
+        return c.author_id == uid and not any(not child.deleted for child in c.children)
+
+    def canMark(self, uid, member):
+        """same as auth.canMarkThread, member being resolver.membership(uid, ensemble)"""
+        if self.root is None:
+            return False
+        if self.root.author_id == uid:
+            return True
+        return member is not None and (self.root.type > 2 or (member.admin and self.root.type > 1))
+
+
+def buildThreads(locations, comments, marks, ratings):
+    """
+    Assembles rows (tuples in the order of the *_FIELDS above) into
+    {location_id: Thread}, and returns it with {threadmark_id: [ReplyRatingRow]}
+    """
+    threads = {}
+    for row in locations:
+        loc = LocationRow(*row)
+        threads[loc.id] = Thread(loc)
+    nodes = {}
+    for row in comments:
+        c = CommentNode(*row)
+        thread = threads.get(c.location_id)
+        if thread is None:
+            continue
+        thread.comments[c.id] = c
+        nodes[c.id] = c
+    for c in nodes.values():
+        if c.parent_id is None:
+            threads[c.location_id].root = c
+        else:
+            parent = nodes.get(c.parent_id)
+            if parent is not None:
+                parent.children.append(c)
+    for row in marks:
+        mark = ThreadMarkRow(*row)
+        thread = threads.get(mark.location_id)
+        if thread is not None:
+            thread.marks.append(mark)
+    mark_ratings = {}
+    for row in ratings:
+        rating = ReplyRatingRow(*row)
+        mark_ratings.setdefault(rating.threadmark_id, []).append(rating)
+    return threads, mark_ratings
+
+
+def loadThreads(id_source, pages=None):
+    """returns ({location_id: Thread}, {threadmark_id: [ReplyRatingRow]}) for that source"""
+    locations = M.Location.objects.filter(source_id=id_source)
+    if pages is not None:
+        locations = locations.filter(page__in=pages)
+    location_ids = locations.values("id")
+    # children are appended in ctime order
+    comments = M.Comment.objects.filter(location_id__in=location_ids).order_by("ctime", "id")
+    marks = M.ThreadMark.objects.filter(location_id__in=location_ids)
+    ratings = M.ReplyRating.objects.filter(threadmark__location_id__in=location_ids)
+    return buildThreads(locations.values_list(*LOCATION_FIELDS),
+                        comments.values_list(*COMMENT_FIELDS),
+                        marks.values_list(*THREADMARK_FIELDS),
+                        ratings.values_list(*REPLYRATING_FIELDS))
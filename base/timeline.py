@@ -0,0 +1,112 @@
+"""
+timeline.py - Time index of the locations of a video source
+
+On YouTube and HTML5 video sources, Location.page is the time of the
+annotation and Location.duration how long it stays on screen.
+timelines.source(id_source) loads all the locations of a source with one
+query into a Timeline, which answers "which locations are active at t" in
+O(log n + k) with a centered interval tree, and "where should playback
+pause between t0 and t1" with a binary search over the locations that
+pause playback: those whose pause flag is set, and, when their ensemble
+has default_pause, those whose thread starts with a staff comment.
+Timelines are kept for TIMELINE_CACHE_TTL seconds, and dropped from
+signals.py when a location of their source, a root comment or an ensemble
+changes.
+"""
+from bisect import bisect_right
+
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+
+from . import models as M
+from .perms import TTLCache
+
+VIDEO_TYPES = (M.Source.TYPE_YOUTUBE, M.Source.TYPE_HTML5VIDEO)
+
+
+class _Node:
+    __slots__ = ("center", "left", "right", "by_start", "by_end")
+
+    def __init__(self, intervals):
+        # intervals: list of (start, end, id), not empty
+        starts = sorted(i[0] for i in intervals)
+        self.center = starts[len(starts) // 2]
+        left = [i for i in intervals if i[1] < self.center]
+        right = [i for i in intervals if i[0] > self.center]
+        here = [i for i in intervals if i[0] <= self.center <= i[1]]
+        self.by_start = sorted(here)
+        self.by_end = sorted(here, key=lambda i: -i[1])
+        self.left = _Node(left) if left else None
+        self.right = _Node(right) if right else None
+
+
+class Timeline:
+    def __init__(self, rows, default_duration=None):
+        """rows: (id, time, duration, pause) for each location"""
+        if default_duration is None:
+            default_duration = getattr(settings, "TIMELINE_DEFAULT_DURATION", 0)
+        intervals = [(t, t + (default_duration if d is None else d), id) for id, t, d, _ in rows]
+        self._root = _Node(intervals) if intervals else None
+        pauses = sorted((t, id) for id, t, _, pause in rows if pause)
+        self._pause_times = [p[0] for p in pauses]
+        self._pause_ids = [p[1] for p in pauses]
+
+    def active(self, t):
+        """ids of the locations active at t, i.e. time <= t <= time + duration"""
+        out = []
+        node = self._root
+        while node is not None:
+            if t < node.center:
+                for start, _, id in node.by_start:
+                    if start > t:
+                        break
+                    out.append(id)
+                node = node.left
+            elif t > node.center:
+                for _, end, id in node.by_end:
+                    if end < t:
+                        break
+                    out.append(id)
+                node = node.right
+            else:
+                out.extend(i[2] for i in node.by_start)
+                break
+        return out
+
+    def pauses(self, t0, t1):
+        """ids of the locations with the pause flag whose time is in (t0, t1], in time order"""
+        return self._pause_ids[bisect_right(self._pause_times, t0):bisect_right(self._pause_times, t1)]
+
+    def nextPause(self, t):
+        """time of the first pause strictly after t, or None"""
+        i = bisect_right(self._pause_times, t)
+        return self._pause_times[i] if i < len(self._pause_times) else None
+
+
+class Timelines:
+    def __init__(self):
+        self._sources = TTLCache(getattr(settings, "TIMELINE_CACHE_TTL", 300),
+                                 getattr(settings, "TIMELINE_CACHE_SIZE", 1000))
+
+    def source(self, id_source):
+        id_source = int(id_source)
+        timeline = self._sources.get(id_source)
+        if timeline is None:
+            root_type = M.Comment.objects.filter(location=OuterRef("pk"), parent=None).values("type")[:1]
+            rows = M.Location.objects.filter(source_id=id_source, source__type__in=VIDEO_TYPES).annotate(
+                root_type=Subquery(root_type)).values_list(
+                "id", "page", "duration", "pause", "ensemble__default_pause", "root_type")
+            # staff comments (type 2) pause by default where the ensemble says so
+            timeline = Timeline([(id, t, d, pause or (default_pause and root_type == 2))
+                                 for id, t, d, pause, default_pause, root_type in rows])
+            self._sources.set(id_source, timeline)
+        return timeline
+
+    def invalidate(self, id_source):
+        self._sources.pop(int(id_source))
+
+    def clear(self):
+        self._sources.clear()
+
+
+timelines = Timelines()
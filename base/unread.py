@@ -0,0 +1,142 @@
+"""
+unread.py - Unread comment counts
+
+PageCommentCount holds the number of comments on each page of a source and
+PageSeenCount the number of distinct ones each user has seen, so that the
+unread count of a page is total - seen without looking at CommentSeen.
+Only the comments every reader of the page can see are counted: class
+comments (type 3) that aren't deleted. Private, staff and tag private ones
+are seen by a few users only, which a per-page total can't express.
+
+Counts are recomputed, not incremented, so that replaying or racing
+updates can't make them drift: the total of a page when one of its
+comments is created, deleted or changes type (signals.py), and the seen
+counts of the affected (user, page) pairs after the CommentSeen buffer of
+seen.py has written its rows, or when a comment they had seen is deleted or
+changes type. Other edits (the body...) don't touch the counts.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Q
+
+from . import models as M
+from .db import Db
+
+# the comments that are counted
+COUNTED = Q(type=3, deleted=False)
+
+FOLDER_UNREAD_QUERY = """
+SELECT c.source_id, SUM(c.total) - COALESCE(SUM(s.seen), 0)
+FROM base_pagecommentcount c
+JOIN base_ownership o ON o.source_id = c.source_id
+LEFT JOIN base_pageseencount s ON s.source_id = c.source_id AND s.page = c.page AND s.user_id = ?
+WHERE o.ensemble_id = ? AND o.deleted = ? AND %s
+GROUP BY c.source_id"""
+
+
+def _set(model, field, lookup, n):
+    if model.objects.filter(**lookup).update(**{field: n}):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **{field: n})
+    except IntegrityError:
+        # created by someone else meanwhile
+        model.objects.filter(**lookup).update(**{field: n})
+
+
+def refreshTotal(source_id, page):
+    n = M.Comment.objects.filter(COUNTED, location__source_id=source_id, location__page=page).count()
+    _set(M.PageCommentCount, "total", {"source_id": source_id, "page": page}, n)
+
+
+def refreshSeen(keys):
+    """recomputes the PageSeenCount of each (user_id, source_id, page) in keys, with one query"""
+    if not keys:
+        return
+    counts = {(r["user_id"], r["comment__location__source_id"], r["comment__location__page"]): r["n"]
+              for r in M.CommentSeen.objects.filter(
+                  user_id__in={k[0] for k in keys}, comment__location__source_id__in={k[1] for k in keys},
+                  comment__location__page__in={k[2] for k in keys},
+                  comment__type=3, comment__deleted=False).values(
+                  "user_id", "comment__location__source_id", "comment__location__page").annotate(
+                  n=Count("comment_id", distinct=True))}
+    for uid, source_id, page in keys:
+        _set(M.PageSeenCount, "seen", {"user_id": uid, "source_id": source_id, "page": page},
+             counts.get((uid, source_id, page), 0))
+
+
+def _seenBy(comment):
+    return list(M.CommentSeen.objects.filter(comment_id=comment.id).values_list("user_id", flat=True).distinct())
+
+
+def _counted(deleted, type):
+    return type == 3 and not deleted
+
+
+def commentSaving(comment):
+    """to call before a comment is saved: remembers whether it was counted"""
+    if comment.pk is not None:
+        old = M.Comment.objects.filter(pk=comment.pk).values_list("deleted", "type").first()
+        comment._unread_counted = None if old is None else _counted(*old)
+
+
+def commentSaved(comment, created, source_id, page):
+    """source_id, page: those of the comment's location"""
+    counted = _counted(comment.deleted, comment.type)
+    before = comment.__dict__.pop("_unread_counted", None)
+    if created:
+        if counted:
+            refreshTotal(source_id, page)
+    elif before != counted:
+        # deleted, restored or changed type (or unknown): it counts
+        # differently for those who saw it too
+        refreshTotal(source_id, page)
+        refreshSeen({(uid, source_id, page) for uid in _seenBy(comment)})
+
+
+def commentDeleting(comment):
+    """to call before a comment is removed (its CommentSeen rows go with it)"""
+    comment._unread_seen_by = _seenBy(comment)
+
+
+def commentDeleted(comment):
+    page = M.Location.objects.filter(pk=comment.location_id).values_list("source_id", "page").first()
+    if page is None:
+        return
+    source_id, page = page
+    refreshTotal(source_id, page)
+    refreshSeen({(uid, source_id, page) for uid in getattr(comment, "_unread_seen_by", ())})
+
+
+def commentsSeen(rows):
+    """updates the seen counts for the CommentSeen rows (instances) that were just written"""
+    cids = {r.comment_id for r in rows}
+    if not cids:
+        return
+    pages = dict((cid, (source_id, page)) for cid, source_id, page in M.Comment.objects.filter(
+        COUNTED, id__in=cids).values_list("id", "location__source_id", "location__page"))
+    refreshSeen({(r.user_id, ) + pages[r.comment_id] for r in rows if r.comment_id in pages})
+
+
+def folderUnread(uid, eid, id_folder=None):
+    """{source_id: number of comments uid hasn't seen} for the sources in that folder of eid"""
+    where, args = ("o.folder_id IS NULL", []) if id_folder is None else ("o.folder_id = ?", [id_folder])
+    rows = Db().getRows(FOLDER_UNREAD_QUERY % where, [uid, eid, False] + args, prepare=True)
+    return {source_id: unread for source_id, unread in rows}
+
+
+def rebuild(id_source):
+    """recomputes the counts of a source from Comment and CommentSeen"""
+    with transaction.atomic():
+        M.PageCommentCount.objects.filter(source_id=id_source).delete()
+        M.PageSeenCount.objects.filter(source_id=id_source).delete()
+        M.PageCommentCount.objects.bulk_create([
+            M.PageCommentCount(source_id=id_source, page=r["location__page"], total=r["n"])
+            for r in M.Comment.objects.filter(COUNTED, location__source_id=id_source).values(
+                "location__page").annotate(n=Count("id"))])
+        M.PageSeenCount.objects.bulk_create([
+            M.PageSeenCount(user_id=r["user_id"], source_id=id_source, page=r["comment__location__page"],
+                            seen=r["n"])
+            for r in M.CommentSeen.objects.filter(comment__location__source_id=id_source, comment__type=3,
+                                                  comment__deleted=False).values(
+                "user_id", "comment__location__page").annotate(n=Count("comment_id", distinct=True))])
@@ -0,0 +1,10 @@
+from django.urls import path
+
+from . import delivery, views
+
+urlpatterns = [
+    path('comments/<int:id_source>', views.comments, name='comments'),
+    path('pdf/<int:id_source>', delivery.pdf, name='pdf'),
+    path('pdf/<int:id_source>/annotated', delivery.annotatedPdf, name='annotated_pdf'),
+    path('pdf/<int:id_source>/page/<int:page>', delivery.page, name='pdf_page'),
+]
@@ -0,0 +1,144 @@
+"""
+views.py - Async read API for annotations
+
+These views are coroutines: under ASGI (docannot/asgi.py) a client waiting
+for new comments only holds an event loop slot, not a worker thread. The
+ORM isn't async yet, so the queries themselves run in a thread through
+sync_to_async. The polls run in the threads of the executor
+(thread_sensitive=False): the default would queue them all on one thread.
+
+GET comments/<id_source>?since=<watermark>&wait=<sec>
+    comments, thread marks and reply ratings of that source inserted or
+    changed (edited, deleted, moderated...) after the watermark, i.e. whose
+    mtime is later. Without since, returns all of them.
+    A row can be committed after a later mtime was already read (a slow
+    transaction, or two rows saved in the same tick), so the last
+    SYNC_OVERLAP seconds before the watermark are read again: clients get
+    some rows twice and apply them by id. Only the comments
+    the user can see are returned, and deleted or moderated ones come
+    without their body; thread marks and reply ratings come with the
+    threads whose root comment the user can see.
+    since is an ISO 8601 datetime (in the server's time zone if it has
+    none), wait a number of seconds.
+    With wait, polls every POLL_INTERVAL seconds until there is something
+    new (a row with a later mtime, or one that was not in the overlap on
+    the first check) or wait seconds passed (long-poll). The response
+    carries the watermark to use for the next call.
+"""
+import asyncio
+import math
+import time
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.utils import timezone
+
+from . import auth
+from . import models as M
+from .perms import resolver
+
+COMMENT_FIELDS = ("id", "location_id", "parent_id", "author_id", "ctime", "body", "type",
+                  "signed", "deleted", "moderated")
+THREADMARK_FIELDS = ("id", "location_id", "comment_id", "user_id", "type", "active", "ctime")
+REPLYRATING_FIELDS = ("id", "threadmark_id", "comment_id", "status", "ctime")
+ROOT_FIELDS = ("id", "location_id", "author_id", "type", "location__ensemble_id")
+
+
+def _user(request):
+    u = auth.getCkeyInfo(request.COOKIES.get("ckey") or request.GET.get("ckey"))
+    return None if u is None else u.id
+
+
+def _canSee(uid, member, c, tagged):
+    # private: author only; staff: admins too; tag private: admins and the
+    # users tagged in it (Tag.individual) too; class: everyone
+    if c["author_id"] == uid or c["type"] == 3:
+        return True
+    admin = member is not None and member.admin
+    return (c["type"] == 2 and admin) or (c["type"] == 4 and (admin or c["id"] in tagged))
+
+
+def changesSince(uid, id_source, since):
+    """
+    comments uid can see, thread marks and reply ratings on id_source
+    changed after since - SYNC_OVERLAP (since is a datetime, or None for all
+    of them), and the new watermark
+    """
+    rows = []
+    for model, fields, source_filter in (
+            (M.Comment, COMMENT_FIELDS + ("location__ensemble_id",), "location__source_id"),
+            (M.ThreadMark, THREADMARK_FIELDS, "location__source_id"),
+            (M.ReplyRating, REPLYRATING_FIELDS + ("threadmark__location_id",), "threadmark__location__source_id")):
+        o = model.objects.filter(**{source_filter: id_source})
+        if since is not None:
+            o = o.filter(mtime__gte=since - timedelta(seconds=getattr(settings, "SYNC_OVERLAP", 5)))
+        rows.append(list(o.order_by("mtime", "id").values(*fields, "mtime")))
+    comments, marks, ratings = rows
+    stamps = [r["mtime"] for r in comments + marks + ratings]
+    watermark = max(stamps) if stamps else since
+    members = resolver.memberships(uid)
+    # marks and ratings go with the root comment of their thread
+    locations = {m["location_id"] for m in marks} | {r["threadmark__location_id"] for r in ratings}
+    roots = list(M.Comment.objects.filter(parent=None, location_id__in=locations).values(
+        *ROOT_FIELDS)) if locations else []
+    tag_private = [c["id"] for c in comments + roots if c["type"] == 4]
+    tagged = set(M.Tag.objects.filter(individual_id=uid, comment_id__in=tag_private).values_list(
+        "comment_id", flat=True)) if tag_private else set()
+    comments = [c for c in comments if _canSee(uid, members.get(c.pop("location__ensemble_id")), c, tagged)]
+    threads = {c["location_id"] for c in roots if _canSee(uid, members.get(c["location__ensemble_id"]), c, tagged)}
+    marks = [m for m in marks if m["location_id"] in threads]
+    ratings = [r for r in ratings if r.pop("threadmark__location_id") in threads]
+    for c in comments:
+        if c["deleted"] or c["moderated"]:
+            # clients only get to know that it's gone
+            c["body"] = None
+    return comments, marks, ratings, watermark
+
+
+def _changesSince(uid, id_source, since):
+    # runs in a thread of the executor, outside of any request: do what the
+    # request_started and request_finished signals do for the others
+    close_old_connections()
+    try:
+        return changesSince(uid, id_source, since)
+    finally:
+        close_old_connections()
+
+
+def _json(rows):
+    for r in rows:
+        r["ctime"] = r["ctime"].isoformat()
+        r["mtime"] = r["mtime"].isoformat()
+    return rows
+
+
+async def comments(request, id_source):
+    uid = await sync_to_async(_user)(request)
+    if uid is None or not await sync_to_async(auth.canReadFile)(uid, id_source, request):
+        return HttpResponseForbidden()
+    try:
+        since = request.GET.get("since")
+        since = datetime.fromisoformat(since) if since else None
+        if since is not None and timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        wait = float(request.GET.get("wait", 0))
+        if not math.isfinite(wait):
+            raise ValueError("wait must be a number of seconds")
+        wait = min(max(wait, 0), getattr(settings, "LONGPOLL_MAX_WAIT", 60))
+    except ValueError:
+        return HttpResponseBadRequest()
+    deadline = time.monotonic() + wait
+    known = None  # rows of the overlap on the first check, that the client may already have
+    while True:
+        c, m, r, watermark = await sync_to_async(_changesSince, thread_sensitive=False)(uid, id_source, since)
+        keys = {(kind, row["id"], row["mtime"]) for kind, rows in (("c", c), ("m", m), ("r", r)) for row in rows}
+        if known is None:
+            known = {k for k in keys if since is not None and k[2] <= since}
+        if keys - known or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(min(getattr(settings, "POLL_INTERVAL", 2), max(deadline - time.monotonic(), 0)))
+    return JsonResponse({"comments": _json(c), "threadmarks": _json(m), "replyratings": _json(r),
+                         "watermark": None if watermark is None else watermark.isoformat()})
@@ -119,3 +119,147 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.1/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Permission cache (see base/perms.py)
+# Number of seconds a user's memberships and a source's ownerships are kept
+# in memory. Changes made through the ORM in this process invalidate them
+# right away; this only bounds staleness across processes.
+
+PERMISSION_CACHE_TTL = 30
+PERMISSION_CACHE_SIZE = 10000
+
+
+# Raw queries (see base/db.py)
+# Number of rows Db.iterRows and Db.iterRowsByName fetch at a time.
+
+DB_FETCH_BATCH_SIZE = 2000
+
+# Number of rows Db.bulkInsert and Db.insertObjects send per round trip.
+
+DB_INSERT_BATCH_SIZE = 1000
+
+# Log every raw query and its arguments (at INFO level) from Db.execute.
+
+DEBUG_QUERY = False
+
+
+# PageSeen / CommentSeen write-behind buffers (see base/seen.py)
+# Rows are written SEEN_BATCH_SIZE at a time, or every SEEN_FLUSH_INTERVAL
+# seconds. At most SEEN_BUFFER_SIZE rows per table are kept in memory; past
+# that, recording an event waits up to SEEN_PUT_TIMEOUT seconds and then
+# drops it.
+
+SEEN_BUFFER_SIZE = 50000
+SEEN_BATCH_SIZE = 500
+SEEN_FLUSH_INTERVAL = 2
+SEEN_PUT_TIMEOUT = 0.05
+
+
+# Folder hierarchy (see base/folders.py)
+# Keep the parent links of each ensemble's folders in memory instead of
+# running a recursive query for each ancestor/descendant question.
+# Folders moved by another process are only seen once the ensemble's entry
+# expires, after FOLDER_TREE_CACHE_TTL seconds.
+
+FOLDER_TREE_CACHE = False
+FOLDER_TREE_CACHE_TTL = 30
+FOLDER_TREE_CACHE_SIZE = 1000
+
+
+# Password hashing (see base/hashers.py)
+# Algorithm used for new passwords; older hashes are upgraded on login.
+# Each PBKDF2 iteration adds CPU time to every login: 100000 iterations
+# take about 50ms on one core.
+
+PASSWORD_HASHER = "pbkdf2_sha256"
+PASSWORD_HASH_ITERATIONS = 100000
+
+
+# Guest pool (see base/guests.py)
+# Number of guest accounts created ahead of time (0 disables the pool),
+# how few may be left before the pool is refilled, and how many guests
+# are inserted per batch when refilling.
+
+GUEST_POOL_SIZE = 0
+GUEST_POOL_MIN = 100
+GUEST_POOL_BATCH = 200
+
+
+# Session activity (see base/activity.py)
+# Session.lastactivity is written at least every ACTIVITY_FLUSH_INTERVAL
+# seconds, and no update waits more than ACTIVITY_MAX_STALENESS seconds
+# (which is only useful when shorter). Gaps of more than IDLE_THRESHOLD
+# seconds between two hits of a session are recorded as Idle periods.
+
+ACTIVITY_FLUSH_INTERVAL = 30
+ACTIVITY_MAX_STALENESS = 10
+IDLE_THRESHOLD = 300
+
+
+# Async read API (see base/views.py)
+# Longest a client may wait for new comments, and how often (in sec) the
+# database is checked meanwhile.
+
+LONGPOLL_MAX_WAIT = 60
+POLL_INTERVAL = 2
+
+# Rows whose mtime is up to this many seconds before the watermark are sent
+# again, in case they were committed after it was read.
+
+SYNC_OVERLAP = 5
+
+
+# Location spatial index (see base/spatial.py)
+# Size of the grid cells, in the units of Location.x/y/w/h, number of
+# pages whose index is kept in memory, and for how long (in sec). This
+# process keeps them up to date: the TTL bounds how long the changes made
+# by other processes go unseen.
+
+SPATIAL_CELL_SIZE = 64
+SPATIAL_CACHE_SIZE = 1000
+SPATIAL_CACHE_TTL = 300
+
+
+# Video timelines (see base/timeline.py)
+# How long (in the units of Location.page) a video location without a
+# duration stays active, number of sources whose timeline is kept, and for
+# how long (in sec).
+
+TIMELINE_DEFAULT_DURATION = 0
+TIMELINE_CACHE_SIZE = 1000
+TIMELINE_CACHE_TTL = 300
+
+
+# HTML5 anchor index (see base/anchors.py)
+# Number of sources whose anchors are kept in memory, and for how long (in
+# sec).
+
+ANCHOR_CACHE_SIZE = 200
+ANCHOR_CACHE_TTL = 300
+
+
+# PDF processing (see base/processing.py)
+# Directory holding the uploaded PDFs (one file per source, named after its
+# id), number of worker processes, and how often (in sec) idle workers
+# check Processqueue. A job not completed PDF_JOB_LEASE seconds after it
+# started can be claimed again, and is given up on after PDF_MAX_ATTEMPTS.
+
+PDF_REPOSITORY = BASE_DIR / 'pdf'
+PDF_WORKERS = 4
+PDF_POLL_INTERVAL = 5
+PDF_JOB_LEASE = 600
+PDF_MAX_ATTEMPTS = 3
+
+
+# Page rendering (see base/render.py)
+# Where rendered pages are cached and how big (in bytes) the cache may get,
+# number of rendering processes, how many pages before and after the
+# requested one are rendered ahead of time, and the resolutions (in dpi)
+# clients may ask for.
+
+RENDER_CACHE_DIR = BASE_DIR / 'render_cache'
+RENDER_CACHE_SIZE = 2 << 30
+RENDER_WORKERS = 4
+RENDER_PREWARM = 2
+RENDER_RESOLUTIONS = (72, 150)